@@ -0,0 +1,117 @@
+import numpy as np
+
+from utils import partition_stroke_ranges
+
+
+# augmentation of a batch of drawings in stroke space, applied to the flat point columns before they are rasterized;
+# all random parameters are drawn per drawing (or per stroke and point) for the whole batch at once, so the cost is
+# negligible compared to the rendering and to pixel space transformations of the (up to 6 channel) images
+#   fliplr_prob: probability of a horizontal flip
+#   scale: maximum relative change of the size of a drawing
+#   shift: maximum shift of a drawing, relative to the canvas size
+#   rotate: maximum rotation of a drawing around the canvas center, in degrees
+#   stroke_dropout: probability of a stroke to be removed, every drawing keeps at least one stroke
+#   point_jitter: standard deviation of the noise added to every point, in the 0-255 stroke coordinates
+#   partition_jitter: maximum number of strokes by which the boundaries of the temporal partitions are moved
+class StrokeAugmentation:
+    def __init__(
+            self,
+            fliplr_prob=0.5,
+            scale=0.0,
+            shift=0.0,
+            rotate=0.0,
+            stroke_dropout=0.0,
+            point_jitter=0.0,
+            partition_jitter=0):
+        self.fliplr_prob = fliplr_prob
+        self.scale = scale
+        self.shift = shift
+        self.rotate = rotate
+        self.stroke_dropout = stroke_dropout
+        self.point_jitter = point_jitter
+        self.partition_jitter = partition_jitter
+
+    def __call__(self, stroke_x, stroke_y, stroke_lens, drawing_offsets):
+        # returns the augmented point columns (as float coordinates if transformed), along with the flips and the
+        # temporal partitions (None if not jittered) to be passed on to draw_temporal_strokes_batch
+        num_drawings = len(drawing_offsets) - 1
+        fliplr = np.random.rand(num_drawings) < self.fliplr_prob
+
+        stroke_x = np.asarray(stroke_x)
+        stroke_y = np.asarray(stroke_y)
+        stroke_lens = np.asarray(stroke_lens)
+        drawing_offsets = np.asarray(drawing_offsets)
+
+        if self.stroke_dropout > 0:
+            stroke_x, stroke_y, stroke_lens, drawing_offsets = \
+                self.drop_strokes(stroke_x, stroke_y, stroke_lens, drawing_offsets)
+
+        if self.scale > 0 or self.shift > 0 or self.rotate > 0 or self.point_jitter > 0:
+            stroke_x, stroke_y = self.transform_points(stroke_x, stroke_y, stroke_lens, drawing_offsets)
+
+        stroke_partitions = None
+        if self.partition_jitter > 0:
+            stroke_partitions = self.jitter_partitions(stroke_lens, drawing_offsets)
+
+        return stroke_x, stroke_y, stroke_lens, drawing_offsets, fliplr, stroke_partitions
+
+    def drop_strokes(self, stroke_x, stroke_y, stroke_lens, drawing_offsets):
+        num_drawings = len(drawing_offsets) - 1
+        drawing_num_strokes = np.diff(drawing_offsets)
+        stroke_drawing = np.repeat(np.arange(num_drawings), drawing_num_strokes)
+
+        keep_stroke = np.random.rand(len(stroke_lens)) >= self.stroke_dropout
+        kept_num_strokes = np.bincount(stroke_drawing[keep_stroke], minlength=num_drawings)
+        keep_stroke[drawing_offsets[:-1][(kept_num_strokes == 0) & (drawing_num_strokes > 0)]] = True
+
+        keep_point = np.repeat(keep_stroke, stroke_lens)
+        kept_drawing_offsets = np.zeros(num_drawings + 1, dtype=np.int32)
+        np.cumsum(np.bincount(stroke_drawing[keep_stroke], minlength=num_drawings), out=kept_drawing_offsets[1:])
+
+        return stroke_x[keep_point], stroke_y[keep_point], stroke_lens[keep_stroke], kept_drawing_offsets
+
+    def transform_points(self, stroke_x, stroke_y, stroke_lens, drawing_offsets):
+        num_drawings = len(drawing_offsets) - 1
+
+        scale = np.random.uniform(1 - self.scale, 1 + self.scale, num_drawings)
+        angle = np.radians(np.random.uniform(-self.rotate, self.rotate, num_drawings))
+        shift_x = np.random.uniform(-self.shift, self.shift, num_drawings) * 256
+        shift_y = np.random.uniform(-self.shift, self.shift, num_drawings) * 256
+
+        # the affine transformation of every drawing, scaled and rotated around the canvas center
+        a = scale * np.cos(angle)
+        b = scale * np.sin(angle)
+
+        stroke_point_offsets = np.zeros(len(stroke_lens) + 1, dtype=np.int64)
+        np.cumsum(stroke_lens, out=stroke_point_offsets[1:])
+        drawing_num_points = stroke_point_offsets[drawing_offsets[1:]] - stroke_point_offsets[drawing_offsets[:-1]]
+
+        point_a = np.repeat(a, drawing_num_points)
+        point_b = np.repeat(b, drawing_num_points)
+        x = stroke_x.astype(np.float64) - 127.5
+        y = stroke_y.astype(np.float64) - 127.5
+        transformed_x = point_a * x - point_b * y + 127.5 + np.repeat(shift_x, drawing_num_points)
+        transformed_y = point_b * x + point_a * y + 127.5 + np.repeat(shift_y, drawing_num_points)
+
+        if self.point_jitter > 0:
+            transformed_x += np.random.normal(0, self.point_jitter, len(transformed_x))
+            transformed_y += np.random.normal(0, self.point_jitter, len(transformed_y))
+
+        return \
+            np.clip(transformed_x, 0, 255).astype(np.float32), \
+            np.clip(transformed_y, 0, 255).astype(np.float32)
+
+    def jitter_partitions(self, stroke_lens, drawing_offsets):
+        num_drawings = len(drawing_offsets) - 1
+        drawing_num_strokes = np.diff(drawing_offsets)
+
+        stroke_partitions = np.array([
+            partition_stroke_ranges(stroke_lens[drawing_offsets[d]:drawing_offsets[d + 1]], 3)
+            for d in range(num_drawings)
+        ], dtype=np.int32).reshape(num_drawings, 4)
+
+        jitter = np.random.randint(-self.partition_jitter, self.partition_jitter + 1, (num_drawings, 2))
+        inner_partitions = np.clip(stroke_partitions[:, 1:3] + jitter, 0, drawing_num_strokes[:, None])
+        stroke_partitions[:, 1:3] = np.sort(inner_partitions, axis=1)
+
+        return stroke_partitions
@@ -0,0 +1,134 @@
+import argparse
+import json
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from utils import draw_temporal_strokes, draw_temporal_strokes_batch, flatten_drawings, str2bool, partition_strokes, \
+    merge_stroke_drawings
+
+
+def draw_temporal_strokes_segments(strokes, size=256, line_width=7, padding=3, extended_channels=True):
+    # the original renderer as the baseline, drawing every segment with its own cv2.line call at 256 and downscaling
+    draw_size = 256
+    scale_factor = (draw_size - 2 * padding) / draw_size
+
+    stroke_colors = range(0, 240, 40)
+
+    partition_images = []
+
+    stroke_color_index = 0
+    for stroke_partition in partition_strokes(strokes, 3):
+        image = np.full((draw_size, draw_size), 255, dtype=np.uint8)
+        partition_images.append(image)
+
+        for stroke in stroke_partition:
+            stroke_color = stroke_colors[stroke_color_index % len(stroke_colors)]
+            stroke_color_index += 1
+            for i in range(len(stroke[0]) - 1):
+                x0 = int(scale_factor * stroke[0][i]) + padding
+                y0 = int(scale_factor * stroke[1][i]) + padding
+                x1 = int(scale_factor * stroke[0][i + 1]) + padding
+                y1 = int(scale_factor * stroke[1][i + 1]) + padding
+                cv2.line(image, (x0, y0), (x1, y1), stroke_color, line_width)
+
+    if draw_size != size:
+        partition_images = [cv2.resize(i, (size, size), interpolation=cv2.INTER_AREA) for i in partition_images]
+
+    final_images = []
+    if extended_channels:
+        final_images.extend(partition_images)
+        final_images.append(merge_stroke_drawings([partition_images[0], partition_images[1]]))
+        final_images.append(merge_stroke_drawings([partition_images[1], partition_images[2]]))
+        final_images.append(merge_stroke_drawings([partition_images[0], partition_images[1], partition_images[2]]))
+    else:
+        final_images.append(partition_images[0])
+        final_images.append(merge_stroke_drawings([partition_images[0], partition_images[1]]))
+        final_images.append(merge_stroke_drawings([partition_images[0], partition_images[1], partition_images[2]]))
+
+    return np.array(final_images)
+
+
+def measure_time(fn, repeats):
+    start_time = time.time()
+    for _ in range(repeats):
+        fn()
+    return (time.time() - start_time) / repeats
+
+
+def main():
+    args = argparser.parse_args()
+    print("Arguments:")
+    for arg in vars(args):
+        print("  {}: {}".format(arg, getattr(args, arg)))
+    print()
+
+    input_dir = args.input_dir
+    num_samples = args.num_samples
+    image_sizes = args.image_sizes
+    extended_channels = args.extended_channels
+    repeats = args.repeats
+
+    df = pd.read_csv(
+        "{}/test_simplified.csv".format(input_dir),
+        nrows=num_samples,
+        usecols=["drawing"],
+        converters={"drawing": json.loads})
+    drawings = df.drawing.values
+
+    stroke_x, stroke_y, stroke_lens, drawing_offsets = flatten_drawings(drawings)
+
+    # the timings are per sample, the mean absolute pixel difference (0-255) of the direct render from the downscaled
+    # one is the accuracy cost of rendering directly at the target size, over all pixels and over the drawn ones only
+    print("size  segments@256 (ms)  sample@256 (ms)  batch@256 (ms)  batch direct (ms)  direct diff (all / drawn)")
+    for size in image_sizes:
+        def render_segments():
+            return np.array([
+                draw_temporal_strokes_segments(d, size=size, extended_channels=extended_channels) for d in drawings])
+
+        def render_samples():
+            return np.array([
+                draw_temporal_strokes(d, size=size, extended_channels=extended_channels) for d in drawings])
+
+        def render_batch(direct):
+            return draw_temporal_strokes_batch(
+                stroke_x,
+                stroke_y,
+                stroke_lens,
+                drawing_offsets,
+                size=size,
+                extended_channels=extended_channels,
+                direct=direct)
+
+        segments_time = measure_time(render_segments, repeats)
+        sample_time = measure_time(render_samples, repeats)
+        batch_time = measure_time(lambda: render_batch(False), repeats)
+        direct_time = measure_time(lambda: render_batch(True), repeats)
+
+        downscaled_images = render_batch(False).astype(np.float32)
+        direct_images = render_batch(True).astype(np.float32)
+        diff = np.abs(downscaled_images - direct_images)
+        drawn = (downscaled_images < 255) | (direct_images < 255)
+
+        print("{:4d}  {:17.4f}  {:15.4f}  {:14.4f}  {:17.4f}  {:10.2f} / {:10.2f}".format(
+            size,
+            1000 * segments_time / len(drawings),
+            1000 * sample_time / len(drawings),
+            1000 * batch_time / len(drawings),
+            1000 * direct_time / len(drawings),
+            diff.mean(),
+            diff[drawn].mean()),
+            flush=True)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--input_dir", default="/storage/kaggle/quickdraw")
+    argparser.add_argument("--num_samples", default=2000, type=int)
+    argparser.add_argument("--image_sizes", default=[32, 64, 96, 128], type=int, nargs="+")
+    argparser.add_argument("--extended_channels", default=False, type=str2bool)
+    argparser.add_argument("--repeats", default=3, type=int)
+
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import math
+import time
+
+import numpy as np
+from sklearn.model_selection import StratifiedShuffleSplit
+
+from dataset import StratifiedSampler
+
+
+# the sampler implementation before it was vectorized
+def gen_sklearn_sample_array(class_vector, batch_size):
+    n_splits = math.ceil(len(class_vector) / batch_size)
+    splitter = StratifiedShuffleSplit(n_splits=n_splits, test_size=0.5)
+    train_index, test_index = next(splitter.split(np.zeros(len(class_vector)), class_vector))
+    return np.hstack([train_index, test_index])
+
+
+def measure_time(fn, repeats):
+    start_time = time.time()
+    for _ in range(repeats):
+        result = fn()
+    return (time.time() - start_time) / repeats, result
+
+
+def calculate_batch_imbalance(class_vector, sample_array, batch_size, num_classes):
+    # mean over the full batches of the L1 distance between the class histogram of the batch and the expected one
+    num_batches = len(sample_array) // batch_size
+    batch_classes = class_vector[sample_array[:num_batches * batch_size]].reshape(num_batches, batch_size)
+    batch_offsets = np.arange(num_batches)[:, None] * num_classes
+    batch_histograms = np.bincount((batch_classes + batch_offsets).ravel(), minlength=num_batches * num_classes)
+    batch_histograms = batch_histograms.reshape(num_batches, num_classes)
+    expected_histogram = batch_size * np.bincount(class_vector, minlength=num_classes) / len(class_vector)
+    return np.abs(batch_histograms - expected_histogram).sum(axis=1).mean()
+
+
+def main():
+    args = argparser.parse_args()
+    print("Arguments:")
+    for arg in vars(args):
+        print("  {}: {}".format(arg, getattr(args, arg)))
+    print()
+
+    num_samples = args.num_samples
+    num_classes = args.num_classes
+    batch_size = args.batch_size
+    repeats = args.repeats
+
+    # slightly imbalanced classes, like the categories of a shard
+    class_weights = np.random.uniform(0.5, 1.5, num_classes)
+    class_vector = np.random.choice(num_classes, num_samples, p=class_weights / class_weights.sum()).astype(np.int16)
+
+    sampler = StratifiedSampler(class_vector, batch_size)
+
+    sklearn_time, sklearn_sample_array = measure_time(
+        lambda: gen_sklearn_sample_array(class_vector, batch_size), repeats)
+    numpy_time, numpy_sample_array = measure_time(sampler.gen_sample_array, repeats)
+
+    assert np.array_equal(np.sort(numpy_sample_array), np.arange(num_samples))
+
+    print("sampler  time (s)  batch imbalance (L1)")
+    for name, sample_time, sample_array in [
+        ("sklearn", sklearn_time, sklearn_sample_array),
+        ("numpy", numpy_time, numpy_sample_array)
+    ]:
+        print("{:7s}  {:8.3f}  {:20.2f}".format(
+            name,
+            sample_time,
+            calculate_batch_imbalance(class_vector, sample_array, batch_size, num_classes)),
+            flush=True)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--num_samples", default=1000000, type=int)
+    argparser.add_argument("--num_classes", default=340, type=int)
+    argparser.add_argument("--batch_size", default=256, type=int)
+    argparser.add_argument("--repeats", default=3, type=int)
+
+    main()
@@ -0,0 +1,126 @@
+import io
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+# writes the checkpoints on a background thread, so that the training only waits for the state to be copied to the
+# cpu memory instead of for it to be serialized and written; a state saved to several files at once (e.g. model.pth and
+# model-{i}.pth) is only copied and serialized once, and the files are written to a temporary file first and renamed,
+# so that a file is never left half written if the training is killed
+class CheckpointWriter:
+    def __init__(self, max_pending_writes=2):
+        self.requests = queue.Queue(maxsize=max_pending_writes)
+        self.error = None
+        self.blocking_times = []
+        self.write_times = []
+        self.write_sizes = []
+
+        self.thread = threading.Thread(target=self.run, name="checkpoint-writer", daemon=True)
+        self.thread.start()
+
+    def save(self, state, file_paths):
+        # returns the time the caller was blocked for, copying the state and waiting for a free slot in the queue
+        self.check_error()
+        if isinstance(file_paths, str):
+            file_paths = [file_paths]
+
+        start_time = time.time()
+        self.requests.put((snapshot_state(state), list(file_paths), time.time()))
+        blocking_time = time.time() - start_time
+        self.blocking_times.append(blocking_time)
+
+        return blocking_time
+
+    def flush(self):
+        # waits until all the pending checkpoints are written
+        self.requests.join()
+        self.check_error()
+
+    def close(self):
+        self.flush()
+        self.requests.put(None)
+        self.thread.join()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                self.requests.task_done()
+                break
+            try:
+                state, file_paths, request_time = request
+                size = write_state(state, file_paths)
+                self.write_times.append(time.time() - request_time)
+                self.write_sizes.append(size)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.requests.task_done()
+
+    def report(self):
+        if len(self.write_times) == 0:
+            return "no checkpoints written"
+        return "{} checkpoints written, {:.1f} MB on average, blocking: {:.3f}s mean / {:.3f}s max, " \
+               "write latency: {:.3f}s mean / {:.3f}s max".format(
+                len(self.write_times),
+                np.mean(self.write_sizes) / 2 ** 20,
+                np.mean(self.blocking_times),
+                np.max(self.blocking_times),
+                np.mean(self.write_times),
+                np.max(self.write_times))
+
+
+def snapshot_state(state):
+    # a copy of all the tensors of a (possibly nested) state dict in cpu memory, which is not changed by the training
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    elif isinstance(state, dict):
+        snapshot = type(state)((k, snapshot_state(v)) for k, v in state.items())
+        # the version metadata of the module state dicts
+        if hasattr(state, "_metadata"):
+            snapshot._metadata = state._metadata
+        return snapshot
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(v) for v in state)
+    else:
+        return state
+
+
+def write_state(state, file_paths):
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+    data = buffer.getbuffer()
+
+    write_file_atomically(file_paths[0], data)
+    for file_path in file_paths[1:]:
+        # the further files are hard links to the first one if possible, replacing one of them later on by another
+        # rename does not change the other ones
+        tmp_file_path = file_path + ".tmp"
+        try:
+            if os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
+            os.link(file_paths[0], tmp_file_path)
+            os.replace(tmp_file_path, file_path)
+        except OSError:
+            write_file_atomically(file_path, data)
+
+    return len(data)
+
+
+def write_file_atomically(file_path, data):
+    tmp_file_path = file_path + ".tmp"
+    with open(tmp_file_path, "wb") as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_file_path, file_path)
@@ -1,17 +1,30 @@
 import datetime
+import functools
+import json
 import math
 import multiprocessing as mp
+import os
+import pickle
+import shutil
+import tempfile
 import time
+from collections import deque
 
 import numpy as np
 import pandas as pd
+import psutil
 import torch
-from sklearn.model_selection import train_test_split, StratifiedShuffleSplit
-from torch.utils.data import Dataset
+import torch.multiprocessing as torch_mp
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
 from torchvision.transforms.functional import normalize
 
-from utils import read_lines, draw_temporal_strokes, read_confusion_set, kfold_split
+from augmentation import StrokeAugmentation
+from strokes import stroke_shard_exists, load_stroke_shard, flatten_drawing_batch, save_stroke_shard, \
+    countrycode_to_country, drawing_num_points, npz_to_stroke_shard
+from utils import read_lines, draw_temporal_strokes, read_confusion_set, draw_temporal_strokes_batch, split_indexes, \
+    split_name, encode_stroke_sequences
 
 class TrainDataProvider:
     def __init__(
@@ -26,7 +39,16 @@ class TrainDataProvider:
             confusion_set,
             num_category_shards,
             category_shard,
-            train_on_val):
+            train_on_val,
+            image_cache_name=None,
+            adaptive_preload=False,
+            max_shard_preload=4,
+            preload_memory_budget=None,
+            rank=0,
+            num_ranks=1,
+            seed=None,
+            shards=None,
+            shard_index=0):
         self.data_dir = data_dir
         self.test_size = test_size
         self.fold = fold
@@ -35,32 +57,87 @@ class TrainDataProvider:
         self.num_category_shards = num_category_shards
         self.category_shard = category_shard
         self.train_on_val = train_on_val
-
-        self.shards = list(range(num_shards))
-        np.random.shuffle(self.shards)
+        self.image_cache_name = image_cache_name
+        # with distributed training every rank trains on its own slice of the same shards, so all ranks need the same
+        # shard order, which is ensured by a common seed
+        self.rank = rank
+        self.num_ranks = num_ranks
+
+        # with adaptive preloading the number of preloaded shards follows the ratio of the shard load time to the time
+        # spent training on a shard, bounded by max_shard_preload and by the memory budget (in bytes) of the shard data
+        self.num_shard_preload = num_shard_preload
+        self.adaptive_preload = adaptive_preload
+        self.max_shard_preload = max_shard_preload
+        self.preload_memory_budget = preload_memory_budget
+        self.load_times = []
+        self.epoch_times = []
+        self.data_memory_size = None
+        self.last_provide_time = None
+        self.stall_time = 0.0
+
+        # a resumed training continues with the shard order and the shard of the interrupted one
+        if shards is not None:
+            self.shards = list(shards)
+        else:
+            self.shards = list(range(num_shards))
+            np.random.RandomState(seed).shuffle(self.shards)
 
         self.pool = mp.Pool(processes=num_workers)
         self.requests = []
 
-        self.next_shard_index = 0
+        self.next_shard_index = shard_index
+        self.provided_shard_index = None
         for _ in range(num_shard_preload):
             self.request_data()
 
     def get_next(self):
         start_time = time.time()
 
-        self.request_data()
+        if self.last_provide_time is not None:
+            self.epoch_times.append(start_time - self.last_provide_time)
+
+        # one more request than the number of shards to preload, as the first one is handed out right away
+        while len(self.requests) < self.calculate_num_shard_preload() + 1:
+            self.request_data()
         data = self.requests.pop(0).get()
+        self.provided_shard_index = self.shards.index(data.shard)
 
         end_time = time.time()
-        print("[{}] Time to provide data of shard {}: {}".format(
+        self.stall_time = end_time - start_time
+        self.last_provide_time = end_time
+        self.load_times.append(data.load_time)
+        self.data_memory_size = data.memory_size
+
+        print("[{}] Time to provide data of shard {}: {} (handoff: {}, rss: {:.2f} GB, preload: {})".format(
             mp.current_process().name,
             data.shard,
-            str(datetime.timedelta(seconds=end_time - start_time))),
+            str(datetime.timedelta(seconds=end_time - start_time)),
+            str(datetime.timedelta(seconds=end_time - max(start_time, data.load_end_time))),
+            psutil.Process().memory_info().rss / 2 ** 30,
+            len(self.requests)),
             flush=True)
 
         return data
 
+    def calculate_num_shard_preload(self):
+        if not self.adaptive_preload or len(self.epoch_times) == 0:
+            return self.num_shard_preload
+
+        # a shard has to be requested as many epochs ahead as its loading takes, the mean over the last few shards
+        # smoothes out the variations of the page cache and of the validation time
+        load_time = np.mean(self.load_times[-5:])
+        epoch_time = max(np.mean(self.epoch_times[-5:]), 1e-3)
+        num_shard_preload = min(math.ceil(load_time / epoch_time), self.max_shard_preload)
+
+        if self.preload_memory_budget is not None:
+            num_shard_preload = min(num_shard_preload, int(self.preload_memory_budget // self.data_memory_size))
+
+        return max(num_shard_preload, 1)
+
+    def state_dict(self):
+        # the shard order and the position of the last provided shard, i.e. the one currently trained on
+        return {"shards": list(self.shards), "shard_index": self.provided_shard_index}
+
     def request_data(self):
         next_shard = self.shards[self.next_shard_index]
         print("[{}] Placing request for shard {}".format(mp.current_process().name, next_shard), flush=True)
@@ -75,10 +152,29 @@ class TrainDataProvider:
                 self.confusion_set,
                 self.num_category_shards,
                 self.category_shard,
-                self.train_on_val
+                self.train_on_val,
+                self.image_cache_name,
+                self.rank,
+                self.num_ranks
             )))
         self.next_shard_index = (self.next_shard_index + 1) % len(self.shards)
 
+    def shard_loader(self):
+        # loads the data of a shard with the settings of this provider, without the pool so that it can be pickled
+        return functools.partial(
+            TrainDataProvider.load_data,
+            data_dir=self.data_dir,
+            test_size=self.test_size,
+            fold=self.fold,
+            train_on_unrecognized=self.train_on_unrecognized,
+            confusion_set=self.confusion_set,
+            num_category_shards=self.num_category_shards,
+            category_shard=self.category_shard,
+            train_on_val=self.train_on_val,
+            image_cache_name=self.image_cache_name,
+            rank=self.rank,
+            num_ranks=self.num_ranks)
+
     @staticmethod
     def load_data(
             data_dir,
@@ -89,7 +185,10 @@ class TrainDataProvider:
             confusion_set,
             num_category_shards,
             category_shard,
-            train_on_val):
+            train_on_val,
+            image_cache_name,
+            rank=0,
+            num_ranks=1):
         print("[{}] Loading data for shard {}".format(mp.current_process().name, shard), flush=True)
         return TrainData(
             data_dir,
@@ -100,7 +199,10 @@ class TrainDataProvider:
             confusion_set,
             num_category_shards,
             category_shard,
-            train_on_val)
+            train_on_val,
+            image_cache_name,
+            rank,
+            num_ranks)
 
 
 class TrainData:
@@ -114,145 +216,206 @@ class TrainData:
             confusion_set,
             num_category_shards,
             category_shard,
-            train_on_val):
+            train_on_val,
+            image_cache_name=None,
+            rank=0,
+            num_ranks=1):
         self.shard = shard
 
         start_time = time.time()
 
-        data_file_name = "{}/train_simplified_shards/shard-{}.npz".format(data_dir, shard)
-        print("Reading data file '{}'".format(data_file_name), flush=True)
+        # the drawings are only ever held as memory mapped flat stroke columns, so that handing the shard over from the
+        # loader process and forking the data loader workers shares the same pages instead of pickling and copying
+        # millions of python objects; shards only available as npz files are converted once on first use
+        stroke_dir_name = "{}/train_simplified_shards/shard-{}".format(data_dir, shard)
+        if not stroke_shard_exists(stroke_dir_name):
+            npz_to_stroke_shard(data_dir, shard, replace=False)
 
-        with np.load(data_file_name) as data_file:
-            data_category = data_file["category"]
-            data_drawing = data_file["drawing"]
-            data_recognized = data_file["recognized"]
-            data_countrycode = data_file["countrycode"]
+        print("Reading stroke data '{}'".format(stroke_dir_name), flush=True)
+
+        data = load_stroke_shard(stroke_dir_name)
+        data_category = np.array(data["category"])
+        data_drawing = data["drawing"]
+        data_recognized = np.array(data["recognized"])
+        data_country = np.array(data["country"])
 
         print("Loaded {} samples".format(len(data_drawing)))
 
         categories = read_lines("{}/categories.txt".format(data_dir))
 
-        countries = read_lines("{}/countries.txt".format(data_dir))
-        country_index_map = {c: countries.index(c) for c in countries}
-
-        data_country = np.array([country_index_map[c] if isinstance(c, str) else 255 for c in data_countrycode], dtype=np.uint8)
+        # all filtering happens on these columns, the drawings are only selected once at the end through the shard row
+        # indexes, as this is expensive for object arrays and would copy the flat stroke columns
+        data = {
+            "category": data_category,
+            "recognized": data_recognized,
+            "country": data_country,
+            "index": np.arange(len(data_category))
+        }
 
         # m = {0: 44, 1: 4, 2: 7, 3: 33, 4: 33, 5: 43, 6: 45, 7: 37, 8: 5, 9: 31, 10: 10, 11: 27, 12: 56, 13: 1, 14: 17, 15: 0, 16: 24, 17: 38, 18: 0, 19: 33, 20: 16, 21: 74, 22: 59, 23: 8, 24: 58, 25: 25, 26: 1, 27: 58, 28: 26, 29: 6, 30: 33, 31: 2, 32: 9, 33: 37, 34: 36, 35: 56, 36: 12, 37: 44, 38: 28, 39: 64, 40: 8, 41: 74, 42: 66, 43: 39, 44: 32, 45: 65, 46: 41, 47: 3, 48: 33, 49: 19, 50: 2, 51: 51, 52: 51, 53: 14, 54: 30, 55: 64, 56: 30, 57: 24, 58: 69, 59: 56, 60: 7, 61: 31, 62: 74, 63: 76, 64: 30, 65: 72, 66: 60, 67: 58, 68: 30, 69: 15, 70: 37, 71: 69, 72: 4, 73: 3, 74: 27, 75: 4, 76: 20, 77: 37, 78: 30, 79: 58, 80: 14, 81: 43, 82: 24, 83: 33, 84: 74, 85: 50, 86: 27, 87: 45, 88: 30, 89: 34, 90: 14, 91: 44, 92: 28, 93: 47, 94: 33, 95: 30, 96: 46, 97: 32, 98: 33, 99: 6, 100: 37, 101: 5, 102: 14, 103: 36, 104: 24, 105: 1, 106: 6, 107: 48, 108: 30, 109: 21, 110: 18, 111: 62, 112: 19, 113: 30, 114: 7, 115: 44, 116: 33, 117: 19, 118: 8, 119: 19, 120: 30, 121: 11, 122: 62, 123: 39, 124: 59, 125: 46, 126: 74, 127: 49, 128: 33, 129: 8, 130: 13, 131: 9, 132: 18, 133: 72, 134: 40, 135: 10, 136: 62, 137: 18, 138: 11, 139: 54, 140: 59, 141: 16, 142: 11, 143: 29, 144: 12, 145: 13, 146: 14, 147: 15, 148: 23, 149: 16, 150: 16, 151: 71, 152: 17, 153: 71, 154: 64, 155: 45, 156: 57, 157: 18, 158: 76, 159: 24, 160: 58, 161: 22, 162: 34, 163: 19, 164: 20, 165: 21, 166: 22, 167: 23, 168: 19, 169: 74, 170: 22, 171: 76, 172: 24, 173: 43, 174: 35, 175: 10, 176: 64, 177: 24, 178: 31, 179: 69, 180: 34, 181: 61, 182: 30, 183: 59, 184: 56, 185: 25, 186: 26, 187: 74, 188: 59, 189: 49, 190: 63, 191: 27, 192: 70, 193: 62, 194: 28, 195: 22, 196: 74, 197: 29, 198: 43, 199: 73, 200: 30, 201: 33, 202: 31, 203: 32, 204: 30, 205: 59, 206: 45, 207: 37, 208: 11, 209: 33, 210: 36, 211: 37, 212: 37, 213: 56, 214: 24, 215: 33, 216: 58, 217: 68, 218: 30, 219: 59, 220: 38, 221: 55, 222: 75, 223: 42, 224: 7, 225: 34, 226: 34, 227: 35, 228: 36, 229: 37, 230: 30, 231: 38, 232: 14, 233: 76, 234: 53, 235: 18, 236: 56, 237: 39, 238: 60, 239: 14, 240: 74, 241: 74, 242: 68, 243: 50, 244: 40, 245: 24, 246: 69, 247: 41, 248: 42, 249: 43, 250: 46, 251: 59, 252: 24, 253: 44, 254: 59, 255: 62, 256: 45, 257: 46, 258: 16, 259: 34, 260: 48, 261: 47, 262: 8, 263: 48, 264: 49, 265: 49, 266: 69, 267: 52, 268: 59, 269: 37, 270: 62, 271: 50, 272: 43, 273: 46, 274: 51, 275: 38, 276: 74, 277: 76, 278: 74, 279: 52, 280: 37, 281: 53, 282: 54, 283: 18, 284: 29, 285: 30, 286: 55, 287: 19, 288: 56, 289: 16, 290: 38, 291: 43, 292: 33, 293: 57, 294: 24, 295: 46, 296: 58, 297: 27, 298: 59, 299: 60, 300: 53, 301: 61, 302: 67, 303: 67, 304: 74, 305: 30, 306: 76, 307: 30, 308: 62, 309: 58, 310: 63, 311: 24, 312: 24, 313: 64, 314: 65, 315: 19, 316: 68, 317: 66, 318: 67, 319: 69, 320: 68, 321: 69, 322: 57, 323: 70, 324: 45, 325: 68, 326: 71, 327: 72, 328: 30, 329: 73, 330: 74, 331: 44, 332: 75, 333: 30, 334: 19, 335: 19, 336: 1, 337: 34, 338: 76, 339: 74}
-        # data_category = np.array([m[c] for c in data_category])
+        # data["category"] = np.array([m[c] for c in data["category"]])
         # categories = ["group{}".format(i) for i in range(max(m.values()) + 1)]
 
         if num_category_shards != 1:
             category_shard_size = len(categories) // num_category_shards
             min_category = category_shard * category_shard_size
             max_category = min(min_category + category_shard_size, len(categories))
-            categories = categories[min_category:max_category]
             print("Using the category range [{},{})".format(min_category, max_category))
 
-            category_filter = (data_category >= min_category) & (data_category < max_category)
-            data_category = data_category[category_filter] - min_category
-            data_drawing = data_drawing[category_filter]
-            data_recognized = data_recognized[category_filter]
-            data_country = data_country[category_filter]
-
-        if fold is None:
-            train_categories, val_categories, train_drawing, val_drawing, train_recognized, val_recognized, train_country, val_country = \
-                train_test_split(
-                    data_category,
-                    data_drawing,
-                    data_recognized,
-                    data_country,
-                    test_size=test_size,
-                    stratify=data_category,
-                    random_state=42
-                )
+            category_subset = CategorySubset(categories, categories[min_category:max_category])
+            data = category_subset.select(data)
+            categories = category_subset.categories
+
+        # the split only depends on the categories of the shard, so it is precomputed during the data preparation for
+        # the full category range; a category shard is split on the fly as its split differs from the full one
+        split_file_name = "{}/train_simplified_shards/shard-{}-{}.npz".format(
+            data_dir, shard, split_name(test_size, fold))
+        if num_category_shards == 1 and os.path.isfile(split_file_name):
+            print("Using split file '{}'".format(split_file_name), flush=True)
+            with np.load(split_file_name) as split_file:
+                train_rows, val_rows = split_file["train"], split_file["val"]
         else:
-            train_indexes, val_indexes = list(kfold_split(3, range(len(data_category)), data_category))[fold]
-
-            train_categories = data_category[train_indexes]
-            train_drawing = data_drawing[train_indexes]
-            train_recognized = data_recognized[train_indexes]
-            train_country = data_country[train_indexes]
+            train_rows, val_rows = split_indexes(data["category"], test_size, fold)
 
-            val_categories = data_category[val_indexes]
-            val_drawing = data_drawing[val_indexes]
-            val_recognized = data_recognized[val_indexes]
-            val_country = data_country[val_indexes]
+        train_data = select_rows(data, train_rows)
+        val_data = select_rows(data, val_rows)
 
         if train_on_val:
-            train_categories = data_category
-            train_drawing = data_drawing
-            train_recognized = data_recognized
-            train_country = data_country
-
-        if False:
-            categories_subset = []
-
-            categories_mask = np.array([c in categories_subset for c in categories])
-
-            train_category_filter = np.array([categories_mask[dc] for dc in train_categories])
-            train_categories = train_categories[train_category_filter]
-            train_drawing = train_drawing[train_category_filter]
-            train_recognized = train_recognized[train_category_filter]
-            train_country = train_country[train_category_filter]
-
-            val_category_filter = np.array([categories_mask[dc] for dc in val_categories])
-            val_categories = val_categories[val_category_filter]
-            val_drawing = val_drawing[val_category_filter]
-            val_recognized = val_recognized[val_category_filter]
-            val_country = val_country[val_category_filter]
+            train_data = data
 
         if confusion_set is not None:
             confusion_set_categories = read_confusion_set(
                 "/storage/models/quickdraw/seresnext50_confusion/confusion_set_{}.txt".format(confusion_set))
 
-            categories_mask = np.array([c in confusion_set_categories for c in categories])
-
-            train_category_filter = np.array([categories_mask[dc] for dc in train_categories])
-            train_categories = train_categories[train_category_filter]
-            train_drawing = train_drawing[train_category_filter]
-            train_recognized = train_recognized[train_category_filter]
-            train_country = train_country[train_category_filter]
-
-            val_category_filter = np.array([categories_mask[dc] for dc in val_categories])
-            val_categories = val_categories[val_category_filter]
-            val_drawing = val_drawing[val_category_filter]
-            val_recognized = val_recognized[val_category_filter]
-            val_country = val_country[val_category_filter]
-
-            category_mapping = {}
-            for csc in confusion_set_categories:
-                category_mapping[categories.index(csc)] = confusion_set_categories.index(csc)
-            train_categories = np.array([category_mapping[c] for c in train_categories])
-            val_categories = np.array([category_mapping[c] for c in val_categories])
-            categories = confusion_set_categories
+            category_subset = CategorySubset(categories, confusion_set_categories)
+            train_data = category_subset.select(train_data)
+            val_data = category_subset.select(val_data)
+            categories = category_subset.categories
 
         if not train_on_unrecognized:
-            train_categories = train_categories[train_recognized]
-            train_drawing = train_drawing[train_recognized]
-            train_country = train_country[train_recognized]
-            train_recognized = train_recognized[train_recognized]
+            train_data = select_rows(train_data, train_data["recognized"])
+
+        # the validation set of all ranks is kept for the evaluation after the training
+        full_val_data = val_data
+        if num_ranks > 1:
+            train_data = select_rank_rows(train_data, rank, num_ranks)
+            val_data = select_rank_rows(val_data, rank, num_ranks)
 
         self.train_set_df = {
-            "category": train_categories,
-            "drawing": train_drawing,
-            "country": train_country,
-            "recognized": train_recognized
+            "category": train_data["category"],
+            "drawing": data_drawing[train_data["index"]],
+            "country": train_data["country"],
+            "recognized": train_data["recognized"]
         }
         self.val_set_df = {
-            "category": val_categories,
-            "drawing": val_drawing,
-            "country": val_country,
-            "recognized": val_recognized
+            "category": val_data["category"],
+            "drawing": data_drawing[val_data["index"]],
+            "country": val_data["country"],
+            "recognized": val_data["recognized"]
         }
+        self.full_val_set_df = {
+            "category": full_val_data["category"],
+            "drawing": data_drawing[full_val_data["index"]],
+            "country": full_val_data["country"],
+            "recognized": full_val_data["recognized"]
+        } if num_ranks > 1 else self.val_set_df
         self.categories = categories
 
+        if image_cache_name is not None:
+            image_file_name = "{}/train_simplified_shards/shard-{}-{}.npy".format(data_dir, shard, image_cache_name)
+            if os.path.isfile(image_file_name):
+                print("Using image cache file '{}'".format(image_file_name), flush=True)
+                self.train_set_df["image"] = ImageCache(image_file_name, train_data["index"])
+                self.val_set_df["image"] = ImageCache(image_file_name, val_data["index"])
+                if num_ranks > 1:
+                    self.full_val_set_df["image"] = ImageCache(image_file_name, full_val_data["index"])
+            else:
+                print("Image cache file '{}' not found, rendering images on the fly".format(image_file_name), flush=True)
+
         end_time = time.time()
         print("Time to load data of shard {}: {}".format(shard, str(datetime.timedelta(seconds=end_time - start_time))),
               flush=True)
 
+        # used by the provider to measure the time between the data being loaded and it being available in the training
+        # process, which is mostly spent transferring the data from the loader process, and to schedule the preloading
+        self.load_end_time = end_time
+        self.load_time = end_time - start_time
+        # the drawings and cached images are memory mapped, so only the per sample columns and indexes take up memory
+        self.memory_size = data_memory_size(self.train_set_df) + data_memory_size(self.val_set_df)
+
+
+# a subset of the categories used for training, with the category labels remapped to the position within the subset;
+# category shards and confusion sets are both expressed as category subsets
+class CategorySubset:
+    def __init__(self, all_categories, categories):
+        self.categories = list(categories)
+
+        all_category_index = {c: i for i, c in enumerate(all_categories)}
+        self.category_map = np.full(len(all_categories), -1, dtype=np.int16)
+        self.category_map[[all_category_index[c] for c in self.categories]] = np.arange(len(self.categories))
+
+    def select(self, data):
+        subset_category = np.take(self.category_map, data["category"])
+        subset_data = select_rows(data, subset_category >= 0)
+        subset_data["category"] = subset_category[subset_category >= 0]
+        return subset_data
+
+
+def select_rows(data, rows):
+    return {k: v[rows] for k, v in data.items()}
+
+
+def select_rank_rows(data, rank, num_ranks):
+    # every rank gets an equally sized slice of the rows, so that all ranks train on the same number of batches
+    num_rank_rows = len(data["category"]) // num_ranks
+    return select_rows(data, np.arange(rank, num_rank_rows * num_ranks, num_ranks))
+
+
+def data_memory_size(data):
+    return sum(v.nbytes if isinstance(v, np.ndarray) else v.indexes.nbytes for v in data.values())
+
+
+class ImageCache:
+    def __init__(self, file_name, indexes):
+        self.file_name = file_name
+        self.indexes = indexes
+        self.images = None
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, index):
+        return self.get_images()[self.indexes[index]]
+
+    def __getstate__(self):
+        # the memory mapped file is reopened on first access after unpickling instead of being copied into the pickle
+        state = self.__dict__.copy()
+        state["images"] = None
+        return state
+
+    @property
+    def image_size(self):
+        return self.get_images().shape[-1]
+
+    def get_images(self):
+        if self.images is None:
+            self.images = np.load(self.file_name, mmap_mode="r")
+        return self.images
+
 
 class TrainDataset(Dataset):
-    def __init__(self, df, num_categories, image_size, use_extended_stroke_channels, augment, use_dummy_image):
+    def __init__(
+            self,
+            df,
+            num_categories,
+            image_size,
+            use_extended_stroke_channels,
+            augment,
+            use_dummy_image,
+            direct_render=False,
+            uint8_images=False,
+            augmentation=None,
+            sequence_len=None):
         super().__init__()
         self.df = df
         self.num_categories = num_categories
@@ -260,86 +423,415 @@ class TrainDataset(Dataset):
         self.use_extended_stroke_channels = use_extended_stroke_channels
         self.augment = augment
         self.use_dummy_image = use_dummy_image
+        self.direct_render = direct_render
+        # the samples only consist of the uint8 image and the category, the conversion of the image to float and the
+        # one hot encoding of the category happen for the whole batch on the device
+        self.uint8_images = uint8_images
+        # the stroke space augmentation used if augment is set, by default only horizontal flips
+        self.augmentation = augmentation if augmentation is not None else StrokeAugmentation()
+        # if set, the samples hold the stroke sequence of (at most sequence_len points of) the drawing instead of the
+        # rendered image, to be padded per batch by collate_stroke_sequences
+        self.sequence_len = sequence_len
 
     def __len__(self):
         return len(self.df["drawing"])
 
     def __getitem__(self, index):
-        drawing = self.df["drawing"][index]
         category = self.df["category"][index]
         country = self.df["country"][index]
 
         if self.use_dummy_image:
-            image = np.zeros((self.image_size, self.image_size))
-        elif "image" in self.df:
+            image = self.create_dummy_image()
+        elif self.sequence_len is not None:
+            image = self.encode_sequences(np.array([index]))[0]
+        elif self.use_image_cache():
             image = self.df["image"][index]
         else:
-            fliplr = False
-            padding = 3
-
-            if self.augment:
-                if np.random.rand() < 0.5:
-                    fliplr = True
-                    # if np.random.rand() < 0.2:
-                    #     padding += np.random.randint(5, 50)
-
-            image = draw_temporal_strokes(
-                drawing,
-                size=self.image_size,
-                padding=padding,
-                fliplr=fliplr,
-                extended_channels=self.use_extended_stroke_channels)
-
-        image = image_to_tensor(image)
-        category = category_to_tensor(category)
-        category_one_hot = category_to_one_hot_tensor(category, self.num_categories)
+            image = self.draw_images(np.array([index]))[0]
 
         # values_channel = calculate_drawing_values_channel(drawing, country, self.image_size)
         # image = torch.cat([torch.from_numpy(values_channel).float().unsqueeze(0), image], dim=0)
 
+        return self.create_sample(image, category)
+
+    def __getitems__(self, indexes):
+        if self.use_dummy_image:
+            return [self[index] for index in indexes]
+
+        if self.sequence_len is not None:
+            images = self.encode_sequences(indexes)
+        elif self.use_image_cache():
+            images = self.df["image"][indexes]
+        else:
+            images = self.draw_images(indexes)
+
+        return [self.create_sample(image, self.df["category"][index]) for image, index in zip(images, indexes)]
+
+    def flatten_drawings(self, indexes):
+        stroke_x, stroke_y, stroke_lens, drawing_offsets = flatten_drawing_batch(self.df["drawing"], indexes)
+
+        fliplr = None
+        stroke_partitions = None
+        if self.augment:
+            stroke_x, stroke_y, stroke_lens, drawing_offsets, fliplr, stroke_partitions = \
+                self.augmentation(stroke_x, stroke_y, stroke_lens, drawing_offsets)
+
+        return stroke_x, stroke_y, stroke_lens, drawing_offsets, fliplr, stroke_partitions
+
+    def draw_images(self, indexes):
+        stroke_x, stroke_y, stroke_lens, drawing_offsets, fliplr, stroke_partitions = self.flatten_drawings(indexes)
+
+        return draw_temporal_strokes_batch(
+            stroke_x,
+            stroke_y,
+            stroke_lens,
+            drawing_offsets,
+            size=self.image_size,
+            padding=3,
+            fliplr=fliplr,
+            extended_channels=self.use_extended_stroke_channels,
+            direct=self.direct_render,
+            stroke_partitions=stroke_partitions)
+
+    def encode_sequences(self, indexes):
+        # the temporal partitions of the augmentation only apply to the rendered images
+        stroke_x, stroke_y, stroke_lens, drawing_offsets, fliplr, _ = self.flatten_drawings(indexes)
+        return encode_stroke_sequences(stroke_x, stroke_y, stroke_lens, drawing_offsets, self.sequence_len, fliplr)
+
+    def sequence_lens(self):
+        return np.minimum(drawing_num_points(self.df["drawing"]), self.sequence_len)
+
+    def use_image_cache(self):
+        # the cached images are rendered without augmentation and only for a single image size
+        return "image" in self.df and not self.augment and self.df["image"].image_size == self.image_size
+
+    def create_dummy_image(self):
+        if self.sequence_len is not None:
+            return np.zeros((4, 1), dtype=np.float32)
+        return np.zeros((self.image_size, self.image_size), dtype=np.uint8)
+
+    def create_sample(self, image, category):
+        if self.sequence_len is not None:
+            image = sequence_to_tensor(image)
+        elif self.uint8_images:
+            image = image_to_uint8_tensor(image)
+        else:
+            image = image_to_tensor(image)
+
+        if self.uint8_images:
+            return image, category_to_tensor(category)
+
+        category = category_to_tensor(category)
+        category_one_hot = category_to_one_hot_tensor(category, self.num_categories)
+
         # image = normalize(image, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
 
         return image, category, category_one_hot
 
 
+# streams the training samples of several shards at once through a shuffle reservoir instead of training on a single
+# shard per epoch, with an epoch being a fixed number of samples; every data loader worker streams its own share of the
+# randomly picked shards, each in a random order, and replaces a shard by another one once all its samples are streamed.
+# As the drawings are memory mapped, the memory use is bounded by the per sample columns of the concurrently streamed
+# shards and by the reservoir, which only holds the shard and row of its samples
+class StreamingTrainDataset(IterableDataset):
+    def __init__(
+            self,
+            shard_loader,
+            shards,
+            num_concurrent_shards,
+            reservoir_size,
+            epoch_size,
+            batch_size,
+            num_categories,
+            image_size,
+            use_extended_stroke_channels,
+            augment,
+            use_dummy_image,
+            direct_render=False,
+            uint8_images=False,
+            augmentation=None,
+            sequence_len=None):
+        super().__init__()
+        self.shard_loader = shard_loader
+        self.shards = shards
+        self.num_concurrent_shards = num_concurrent_shards
+        self.reservoir_size = reservoir_size
+        self.batch_size = batch_size
+        self.num_batches = math.ceil(epoch_size / batch_size)
+        self.num_categories = num_categories
+        self.image_size = image_size
+        self.use_extended_stroke_channels = use_extended_stroke_channels
+        self.augment = augment
+        self.use_dummy_image = use_dummy_image
+        self.direct_render = direct_render
+        self.uint8_images = uint8_images
+        self.augmentation = augmentation
+        self.sequence_len = sequence_len
+
+    def __len__(self):
+        return self.num_batches * self.batch_size
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        # a new seed for every epoch, drawn from the random state of the training process: the data loader draws the
+        # seeds of its workers anew for every epoch, without workers it is drawn here
+        seed = np.random.randint(2 ** 31 - 1) if worker_info is None else worker_info.seed
+        random_state = np.random.RandomState(seed % 2 ** 32)
+        reservoir_size = max(self.reservoir_size // num_workers, self.batch_size)
+
+        # the workers are forked anew for every epoch and load their shards again, so the concurrently streamed shards
+        # are split over the workers to keep the number of loaded shards (and their per sample columns in memory) at
+        # num_concurrent_shards in total instead of per worker
+        num_concurrent_shards = min(max(self.num_concurrent_shards // num_workers, 1), len(self.shards))
+
+        streams = {}
+        reservoir_stream, reservoir_row = \
+            self.next_samples(streams, random_state, reservoir_size, num_concurrent_shards)
+
+        # the worker renders the batches with the same index modulo the number of workers, so that the data loader
+        # collates them back into full batches
+        for _ in range(worker_id, self.num_batches, num_workers):
+            batch_stream, batch_row = self.next_samples(streams, random_state, self.batch_size, num_concurrent_shards)
+
+            slots = random_state.choice(reservoir_size, self.batch_size, replace=False)
+            batch_stream, reservoir_stream[slots] = reservoir_stream[slots], batch_stream
+            batch_row, reservoir_row[slots] = reservoir_row[slots], batch_row
+
+            samples = []
+            for stream_id in np.unique(batch_stream):
+                samples.extend(streams[stream_id]["dataset"].__getitems__(batch_row[batch_stream == stream_id]))
+            for sample in samples:
+                yield sample
+
+            # the streams which are completely streamed are dropped once none of their samples is left in the reservoir
+            for stream_id in [i for i, stream in streams.items() if stream["position"] == len(stream["rows"])]:
+                if not np.any(reservoir_stream == stream_id):
+                    del streams[stream_id]
+
+    def next_samples(self, streams, random_state, num_samples, num_concurrent_shards):
+        sample_stream = []
+        sample_row = []
+        while num_samples > 0:
+            active_stream_ids = [i for i, stream in streams.items() if stream["position"] < len(stream["rows"])]
+            if len(active_stream_ids) < num_concurrent_shards:
+                self.open_stream(streams, random_state)
+                continue
+
+            counts = np.bincount(random_state.randint(len(active_stream_ids), size=num_samples),
+                                 minlength=len(active_stream_ids))
+            for stream_id, count in zip(active_stream_ids, counts):
+                stream = streams[stream_id]
+                rows = stream["rows"][stream["position"]:stream["position"] + count]
+                stream["position"] += len(rows)
+                sample_stream.append(np.full(len(rows), stream_id, dtype=np.int32))
+                sample_row.append(rows)
+                num_samples -= len(rows)
+
+        return np.concatenate(sample_stream), np.concatenate(sample_row)
+
+    def open_stream(self, streams, random_state):
+        active_shards = [stream["shard"] for stream in streams.values() if stream["position"] < len(stream["rows"])]
+        shard = random_state.choice([s for s in self.shards if s not in active_shards])
+
+        train_data = self.shard_loader(shard=shard)
+        dataset = TrainDataset(
+            train_data.train_set_df,
+            self.num_categories,
+            self.image_size,
+            self.use_extended_stroke_channels,
+            self.augment,
+            self.use_dummy_image,
+            self.direct_render,
+            self.uint8_images,
+            self.augmentation,
+            self.sequence_len)
+
+        stream_id = max(streams.keys(), default=-1) + 1
+        streams[stream_id] = {
+            "shard": shard,
+            "dataset": dataset,
+            "rows": random_state.permutation(len(dataset)),
+            "position": 0
+        }
+
+
 class TestData:
     def __init__(self, data_dir):
-        self.df = pd.read_csv(
-            "{}/test_simplified.csv".format(data_dir),
-            index_col="key_id",
-            converters={"drawing": lambda drawing: eval(drawing)})
+        start_time = time.time()
 
-        countries = read_lines("{}/countries.txt".format(data_dir))
-        self.df["country"] = [countries.index(c) if isinstance(c, str) else 255 for c in self.df.countrycode]
+        # the test set is converted once into the columnar stroke format and memory mapped on subsequent runs
+        strokes_dir_name = "{}/test_simplified".format(data_dir)
+        if not stroke_shard_exists(strokes_dir_name, data_columns=["key_id", "country"]):
+            TestData.prepare_strokes(data_dir, strokes_dir_name)
+
+        data = load_stroke_shard(strokes_dir_name)
+        self.drawing = data["drawing"]
+        self.country = np.array(data["country"])
+        self.df = pd.DataFrame({"country": self.country}, index=pd.Index(np.array(data["key_id"]), name="key_id"))
+
+        end_time = time.time()
+        print("Time to load test data: {}".format(str(datetime.timedelta(seconds=end_time - start_time))), flush=True)
+
+    @staticmethod
+    def prepare_strokes(data_dir, strokes_dir_name):
+        csv_file_name = "{}/test_simplified.csv".format(data_dir)
+        print("Converting test data file '{}'".format(csv_file_name), flush=True)
+
+        df = pd.read_csv(csv_file_name, converters={"drawing": json.loads})
+        country = countrycode_to_country(df.countrycode.values, "{}/countries.txt".format(data_dir))
+
+        save_stroke_shard(strokes_dir_name, df.key_id.values, None, None, country, df.drawing.values, replace=False)
 
 
 class TestDataset(Dataset):
-    def __init__(self, df, image_size, use_extended_stroke_channels):
+    def __init__(self, drawing, country, image_size, use_extended_stroke_channels, direct_render=False,
+                 uint8_images=False, sequence_len=None):
         super().__init__()
-        self.df = df
+        # plain positional columns, so that no per sample pandas lookups are needed in the data loader workers
+        self.drawing = drawing
+        self.country = np.asarray(country)
         self.image_size = image_size
         self.use_extended_stroke_channels = use_extended_stroke_channels
+        self.direct_render = direct_render
+        self.uint8_images = uint8_images
+        self.sequence_len = sequence_len
 
     def __len__(self):
-        return len(self.df)
+        return len(self.drawing)
 
     def __getitem__(self, index):
-        drawing = self.df.iloc[index].drawing
-        country = self.df.iloc[index].country
+        drawing = self.drawing[index]
+        country = self.country[index]
+
+        if self.sequence_len is not None:
+            return self.__getitems__(np.array([index]))[0]
 
         image = draw_temporal_strokes(
             drawing,
             size=self.image_size,
             padding=3,
-            extended_channels=self.use_extended_stroke_channels)
+            extended_channels=self.use_extended_stroke_channels,
+            direct=self.direct_render)
 
-        image = image_to_tensor(image)
+        image = image_to_uint8_tensor(image) if self.uint8_images else image_to_tensor(image)
 
         # values_channel = calculate_drawing_values_channel(drawing, country, self.image_size)
         # image = torch.cat([torch.from_numpy(values_channel).float().unsqueeze(0), image], dim=0)
 
         return (image,)
 
+    def __getitems__(self, indexes):
+        if self.sequence_len is not None:
+            sequences = encode_stroke_sequences(*flatten_drawing_batch(self.drawing, indexes), self.sequence_len)
+            return [(sequence_to_tensor(sequence),) for sequence in sequences]
+
+        images = draw_temporal_strokes_batch(
+            *flatten_drawing_batch(self.drawing, indexes),
+            size=self.image_size,
+            padding=3,
+            extended_channels=self.use_extended_stroke_channels,
+            direct=self.direct_render)
+
+        if self.uint8_images:
+            return [(image,) for image in torch.from_numpy(images)]
+        else:
+            return [(image,) for image in image_to_tensor(images)]
+
+
+# a data loader whose worker processes live as long as the loader, while the workers of a DataLoader are forked again for
+# every iteration over the data; the dataset is written to a file at the start of every iteration and the workers only
+# reload it when its name changes, so that a batch request only carries the file name along with the sample indexes
+class PersistentDataLoader:
+    def __init__(self, dataset, batch_size, sampler=None, num_workers=8, pin_memory=False, num_prefetch_batches=2,
+                 collate_fn=default_collate, batch_sampler=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.batch_sampler = batch_sampler
+        self.collate_fn = collate_fn
+        self.pin_memory = pin_memory
+        self.num_pending_batches = num_workers * num_prefetch_batches
+
+        self.data_dir_name = tempfile.mkdtemp(prefix="persistent-data-loader-")
+        self.data_file_name = None
+        self.data_file_count = 0
+
+        # torch multiprocessing passes the tensors of the batches through shared memory instead of pickling them
+        self.pool = torch_mp.Pool(processes=num_workers, initializer=PersistentDataLoader.init_worker)
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        return math.ceil(len(self.sampler if self.sampler is not None else self.dataset) / self.batch_size)
+
+    def __iter__(self):
+        self.write_data_file()
+
+        # every batch gets its own seed drawn in the main process, so that the augmentations do not depend on the
+        # worker a batch is rendered by and are reproduced by a training resumed with the same random state
+        requests = deque()
+        for batch_indexes in self.generate_batches():
+            requests.append(self.pool.apply_async(
+                PersistentDataLoader.load_batch,
+                (self.data_file_name, batch_indexes, self.collate_fn, np.random.randint(2 ** 31 - 1))))
+            if len(requests) >= self.num_pending_batches:
+                yield self.get_batch(requests.popleft())
+        while len(requests) > 0:
+            yield self.get_batch(requests.popleft())
+
+    def generate_batches(self):
+        if self.batch_sampler is not None:
+            return iter(self.batch_sampler)
+
+        if self.sampler is not None:
+            indexes = np.fromiter(iter(self.sampler), dtype=np.int64)
+        else:
+            indexes = np.arange(len(self.dataset))
+        return (indexes[start:start + self.batch_size] for start in range(0, len(indexes), self.batch_size))
+
+    def get_batch(self, request):
+        batch = request.get()
+        if self.pin_memory:
+            batch = [t.pin_memory() for t in batch]
+        return batch
+
+    def write_data_file(self):
+        self.data_file_count += 1
+        data_file_name = "{}/data-{}.pkl".format(self.data_dir_name, self.data_file_count)
+        with open(data_file_name, "wb") as data_file:
+            pickle.dump(self.dataset, data_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if self.data_file_name is not None:
+            os.remove(self.data_file_name)
+        self.data_file_name = data_file_name
+
+    def close(self):
+        self.pool.terminate()
+        shutil.rmtree(self.data_dir_name)
+
+    worker_data_file_name = None
+    worker_dataset = None
+
+    @staticmethod
+    def init_worker():
+        # the forked workers would otherwise all draw the same augmentations
+        np.random.seed()
+
+    @staticmethod
+    def load_batch(data_file_name, indexes, collate_fn, seed=None):
+        if seed is not None:
+            np.random.seed(seed)
+
+        if PersistentDataLoader.worker_data_file_name != data_file_name:
+            with open(data_file_name, "rb") as data_file:
+                PersistentDataLoader.worker_dataset = pickle.load(data_file)
+            PersistentDataLoader.worker_data_file_name = data_file_name
+
+        return collate_fn(PersistentDataLoader.worker_dataset.__getitems__(indexes))
+
 
 def image_to_tensor(image):
     if len(image.shape) == 2:
@@ -347,6 +839,34 @@ def image_to_tensor(image):
     return torch.from_numpy(image / 255.).float()
 
 
+def image_to_uint8_tensor(image):
+    if len(image.shape) == 2:
+        image = np.expand_dims(image, 0)
+    return torch.from_numpy(np.ascontiguousarray(image))
+
+
+def sequence_to_tensor(sequence):
+    return torch.from_numpy(np.ascontiguousarray(sequence))
+
+
+def collate_stroke_sequences(samples):
+    # pads the stroke sequences with zeros to the longest one of the batch, the remaining sample values are collated
+    # as usual; a batch of empty drawings still gets one (invalid) point, as the convolutions need a non empty input
+    sequences = [s[0] for s in samples]
+    max_len = max(max(s.size(1) for s in sequences), 1)
+    padded_sequences = torch.zeros((len(sequences), sequences[0].size(0), max_len), dtype=sequences[0].dtype)
+    for i, s in enumerate(sequences):
+        padded_sequences[i, :, :s.size(1)] = s
+    if len(samples[0]) == 1:
+        return [padded_sequences]
+    return [padded_sequences] + default_collate([s[1:] for s in samples])
+
+
+def categories_to_one_hot(categories, num_categories):
+    categories_one_hot = torch.zeros((len(categories), num_categories), dtype=torch.float32, device=categories.device)
+    return categories_one_hot.scatter_(1, categories.view(-1, 1), 1.0)
+
+
 def category_to_tensor(category):
     return torch.tensor(category.item()).long()
 
@@ -364,13 +884,77 @@ class StratifiedSampler(Sampler):
         self.batch_size = batch_size
 
     def gen_sample_array(self):
-        n_splits = math.ceil(len(self.class_vector) / self.batch_size)
-        splitter = StratifiedShuffleSplit(n_splits=n_splits, test_size=0.5)
-        train_index, test_index = next(splitter.split(np.zeros(len(self.class_vector)), self.class_vector))
-        return np.hstack([train_index, test_index])
+        # the samples of every class are spread evenly over the whole epoch: within its class a sample gets a random
+        # rank, and its position is the rank plus a random offset of the class relative to the class size, so that the
+        # samples of a class are equally spaced and every batch contains each class proportionally to its frequency
+        class_vector = np.asarray(self.class_vector)
+        permutation = np.random.permutation(len(class_vector))
+        classes = class_vector[permutation]
+
+        class_counts = np.bincount(classes)
+        class_starts = np.cumsum(class_counts) - class_counts
+        class_order = np.argsort(classes, kind="stable")
+
+        class_ranks = np.empty(len(classes), dtype=np.float64)
+        class_ranks[class_order] = np.arange(len(classes)) - np.repeat(class_starts, class_counts)
+        positions = (class_ranks + np.random.rand(len(class_counts))[classes]) / class_counts[classes]
+
+        return permutation[np.argsort(positions)]
 
     def __iter__(self):
         return iter(self.gen_sample_array())
 
     def __len__(self):
         return len(self.class_vector)
+
+
+# batches of samples with a similar number of points, to reduce the padding of the stroke sequences: the samples are
+# assigned to length buckets by the quantiles of their lengths and every bucket is cut into full batches in the
+# stratified order, so that the batches are still stratified within their bucket; the remainders of the buckets are
+# cut into shared batches of neighbouring buckets instead of ending every bucket with its own partial batch, and a last
+# batch of a single sample (which batch norm cannot train on) is merged into the previous one; the batches of all
+# buckets are shuffled
+class BucketBatchSampler(StratifiedSampler):
+    def __init__(self, class_vector, lengths, batch_size, num_buckets=8):
+        super().__init__(class_vector, batch_size)
+        self.lengths = lengths
+        self.num_buckets = num_buckets
+
+    def assign_buckets(self):
+        lengths = np.asarray(self.lengths)
+        bucket_edges = np.quantile(lengths, np.linspace(0, 1, self.num_buckets + 1)[1:-1])
+        return np.searchsorted(bucket_edges, lengths, side="right")
+
+    def gen_batches(self):
+        sample_array = self.gen_sample_array()
+        buckets = self.assign_buckets()[sample_array]
+        sample_array = sample_array[np.argsort(buckets, kind="stable")]
+
+        bucket_counts = np.bincount(buckets, minlength=self.num_buckets)
+        bucket_ends = np.cumsum(bucket_counts)
+        batches = []
+        remainders = []
+        for bucket_start, bucket_end in zip(bucket_ends - bucket_counts, bucket_ends):
+            full_end = bucket_end - (bucket_end - bucket_start) % self.batch_size
+            for start in range(bucket_start, full_end, self.batch_size):
+                batches.append(sample_array[start:start + self.batch_size])
+            remainders.append(sample_array[full_end:bucket_end])
+
+        remainder_array = np.concatenate(remainders)
+        for start in range(0, len(remainder_array), self.batch_size):
+            batches.append(remainder_array[start:start + self.batch_size])
+        if len(batches) > 1 and len(batches[-1]) < 2:
+            last_batch = batches.pop()
+            batches[-1] = np.concatenate([batches[-1], last_batch])
+
+        return [batches[i] for i in np.random.permutation(len(batches))]
+
+    def __iter__(self):
+        return iter(self.gen_batches())
+
+    def __len__(self):
+        num_samples = len(self.lengths)
+        num_batches = math.ceil(num_samples / self.batch_size)
+        if num_batches > 1 and num_samples % self.batch_size == 1:
+            num_batches -= 1
+        return num_batches
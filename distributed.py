@@ -0,0 +1,79 @@
+import os
+import sys
+
+import torch
+import torch.distributed as dist
+
+
+# multi-process data parallel training, with one process per rank as started by torchrun (which sets the RANK,
+# WORLD_SIZE, LOCAL_RANK and MASTER_* environment variables); the gloo backend also runs on cpu only machines
+def init_distributed(backend="gloo"):
+    if "WORLD_SIZE" not in os.environ:
+        raise Exception("Distributed training has to be started with torchrun")
+
+    dist.init_process_group(backend=backend)
+
+    # only the first rank logs, the other ones train silently
+    if not is_main_process():
+        sys.stdout = open(os.devnull, "w")
+
+    return get_rank(), get_world_size()
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def local_rank():
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def average_across_ranks(values):
+    if not dist.is_initialized():
+        return values
+    values_t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(values_t, op=dist.ReduceOp.SUM)
+    return (values_t / get_world_size()).tolist()
+
+
+def shared_random_seed():
+    # a random seed drawn by the first rank, the same on all ranks
+    seed_t = torch.randint(2 ** 31 - 1, (1,), dtype=torch.int64)
+    if dist.is_initialized():
+        dist.broadcast(seed_t, src=0)
+    return seed_t.item()
+
+
+def min_across_ranks(value):
+    if not dist.is_initialized():
+        return value
+    value_t = torch.tensor(value, dtype=torch.int64)
+    dist.all_reduce(value_t, op=dist.ReduceOp.MIN)
+    return value_t.item()
+
+
+# a stand in for the summary writers of the ranks which do not log
+class NullSummaryWriter:
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
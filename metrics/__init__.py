@@ -4,5 +4,6 @@ from .center_loss import CenterLoss
 from .focal_loss import FocalLoss
 from .hard_bootstraping_loss import HardBootstrapingLoss
 from .mapk import mapk
+from .metric_accumulator import MetricAccumulator, batch_loss, batch_mapk, batch_accuracy
 from .soft_bootstraping_loss import SoftBootstrapingLoss
 from .soft_cross_entropy_loss import SoftCrossEntropyLoss
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+import torch
+
+
+# the values of a batch shared by all metrics: the top k categories are only computed once per batch, and hits[:, k]
+# tells whether the (k+1)-th predicted category is the actual one
+class MetricBatch:
+    def __init__(self, prediction_logits, categories, topk, loss=None):
+        self.prediction_logits = prediction_logits
+        self.categories = categories
+        self.loss = loss
+
+        # the softmax is monotonic, so the top k of the logits are the top k of the predictions
+        _, self.predicted_categories = prediction_logits.topk(topk, dim=1, sorted=True)
+        self.hits = torch.eq(self.predicted_categories, categories.view(-1, 1))
+
+
+# accumulates the registered metrics over all batches on the device, so that there is no synchronization before the
+# results are requested; a metric is a function of a MetricBatch returning a tensor (of any shape, e.g. one value per
+# category) which is either averaged over the batches ("mean") or summed up ("sum")
+class MetricAccumulator:
+    def __init__(self, topk):
+        self.topk = topk
+        self.metrics = OrderedDict()
+        self.sums = {}
+        self.step_count = 0
+
+    def register(self, name, metric, reduction="mean"):
+        self.metrics[name] = (metric, reduction)
+        return self
+
+    def update(self, prediction_logits, categories, loss=None):
+        batch = MetricBatch(prediction_logits, categories, min(self.topk, prediction_logits.size(1)), loss)
+        for name, (metric, _) in self.metrics.items():
+            value = metric(batch).detach()
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+        self.step_count += 1
+
+    def results(self):
+        # a single transfer of all the scalar results from the device
+        names = [n for n in self.metrics.keys() if n in self.sums]
+        scalar_names = [n for n in names if self.sums[n].dim() == 0]
+        scalar_sums = torch.stack([self.sums[n].float() for n in scalar_names]).tolist() if scalar_names else []
+
+        results = {}
+        for name in names:
+            total = scalar_sums[scalar_names.index(name)] if name in scalar_names else self.sums[name].cpu().numpy()
+            results[name] = total / self.step_count if self.metrics[name][1] == "mean" else total
+        return results
+
+
+def batch_loss(batch):
+    return batch.loss
+
+
+def batch_mapk(batch, topk=3):
+    topk = min(topk, batch.hits.size(1))
+    weights = 1.0 / torch.arange(1, topk + 1, dtype=torch.float32, device=batch.hits.device)
+    return (batch.hits[:, :topk].float() * weights).sum(dim=1).mean()
+
+
+def batch_accuracy(batch, topk=3):
+    topk = min(topk, batch.hits.size(1))
+    return batch.hits[:, :topk].float().sum(dim=1).mean()
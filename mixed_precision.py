@@ -0,0 +1,47 @@
+import torch
+
+
+# automatic mixed precision for the forward passes: fp16 with dynamic loss scaling on cuda and bf16 (which needs no loss
+# scaling) on the cpu; if the device supports neither it falls back to fp32, with autocast and the scaler turned into
+# no-ops, so that the training loop is the same in all cases
+class MixedPrecision:
+    def __init__(self, device, enabled=False):
+        self.device = device
+        self.dtype = None
+        self.scaler = self.create_scaler()
+        if enabled:
+            self.enable()
+
+    @property
+    def enabled(self):
+        return self.dtype is not None
+
+    def enable(self):
+        self.dtype = self.find_supported_dtype()
+        if self.dtype is None:
+            print("mixed precision is not supported on device '{}', falling back to fp32".format(self.device),
+                  flush=True)
+        self.scaler = self.create_scaler()
+        return self.enabled
+
+    def disable(self):
+        self.dtype = None
+        self.scaler = self.create_scaler()
+
+    def find_supported_dtype(self):
+        dtype = torch.float16 if self.device.type == "cuda" else torch.bfloat16
+        try:
+            with torch.autocast(self.device.type, dtype=dtype):
+                torch.ones((2, 2), device=self.device).mm(torch.ones((2, 2), device=self.device))
+            return dtype
+        except (RuntimeError, AssertionError):
+            return None
+
+    def create_scaler(self):
+        return torch.amp.GradScaler(self.device.type, enabled=self.dtype == torch.float16)
+
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.dtype, enabled=self.enabled)
+
+    def describe(self):
+        return str(self.dtype).replace("torch.", "") if self.enabled else "fp32"
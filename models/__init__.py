@@ -9,3 +9,4 @@ from .nasnet_wrapper import NasNet
 from .resnet import ResNet
 from .senet_wrapper import SeNet, SeResNext50Cs
 from .stack import StackNet
+from .stroke_cnn import StrokeCnn
@@ -1,4 +1,6 @@
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class Flatten(nn.Module):
@@ -16,3 +18,26 @@ class ExpandChannels2d(nn.Module):
             return x.expand(-1, self.num_channels, -1, -1)
         else:
             return x
+
+
+class Uint8ToFloat2d(nn.Module):
+    def forward(self, x):
+        # the images are transferred to the device as uint8 and only scaled to [0, 1] there, float images are passed as is
+        if x.dtype == torch.uint8:
+            return x.float().div_(255.)
+        else:
+            return x
+
+
+class ResizeImage2d(nn.Module):
+    def __init__(self, size=None):
+        super().__init__()
+        self.size = size
+
+    def forward(self, x):
+        # area downsampling of the images rendered at full size, e.g. to train on smaller images at first
+        # stroke sequences (3d instead of 4d inputs) are passed as is
+        if self.size is None or x.dim() != 4 or x.size(-1) == self.size:
+            return x
+        else:
+            return F.adaptive_avg_pool2d(x, self.size)
@@ -0,0 +1,61 @@
+import math
+
+import torch
+import torch.nn as nn
+
+
+class StrokeConvBlock(nn.Module):
+    def __init__(self, in_channels, out_channels, kernel_size, dilation=1):
+        super().__init__()
+        self.delegate = nn.Sequential(
+            nn.Conv1d(in_channels, out_channels, kernel_size=kernel_size, padding=dilation * (kernel_size // 2),
+                      dilation=dilation),
+            nn.ReLU(inplace=True),
+            nn.BatchNorm1d(out_channels)
+        )
+
+    def forward(self, x, mask):
+        # the padded positions are reset after every block, so that they do not leak into the valid ones
+        return self.delegate(x) * mask
+
+
+# 1d convolutions over the stroke sequences of encode_stroke_sequences instead of the rendered images, with the last
+# input channel marking the valid (not padded) points; the dilations grow the receptive field to about 200 points
+class StrokeCnn(nn.Module):
+    def __init__(self, num_classes, in_channels=4):
+        super().__init__()
+
+        self.blocks = nn.ModuleList([
+            StrokeConvBlock(in_channels, 64, kernel_size=5),
+            StrokeConvBlock(64, 64, kernel_size=5, dilation=2),
+            StrokeConvBlock(64, 128, kernel_size=5, dilation=4),
+            StrokeConvBlock(128, 128, kernel_size=5, dilation=8),
+            StrokeConvBlock(128, 256, kernel_size=5, dilation=16),
+            StrokeConvBlock(256, 256, kernel_size=3)
+        ])
+
+        self.classifier = nn.Sequential(
+            nn.Linear(2 * 256, 512),
+            nn.ReLU(inplace=True),
+            nn.BatchNorm1d(512),
+            nn.Linear(512, num_classes)
+        )
+
+        for m in self.modules():
+            if isinstance(m, nn.Conv1d):
+                n = m.kernel_size[0] * m.out_channels
+                m.weight.data.normal_(0, math.sqrt(2. / n))
+
+    def forward(self, x):
+        mask = x[:, -1:]
+        for block in self.blocks:
+            x = block(x, mask)
+
+        # global average and max pooling over the valid points only
+        num_points = mask.sum(dim=2)
+        avg_pool = x.sum(dim=2) / num_points.clamp(min=1)
+        max_pool = x.masked_fill(mask == 0, float("-inf")).max(dim=2)[0]
+        # drawings without any points (e.g. dummy samples) pool to zeros
+        max_pool = max_pool.masked_fill(num_points == 0, 0)
+
+        return self.classifier(torch.cat([avg_pool, max_pool], dim=1))
@@ -9,15 +9,17 @@ import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 from torch.utils.data import DataLoader
 
-from dataset import TestData, TestDataset, TrainDataset, TrainDataProvider
+from dataset import TestData, TestDataset, TrainDataset, TrainDataProvider, collate_stroke_sequences
+from models.common import Uint8ToFloat2d
 from models.ensemble import Ensemble
-from train import create_model
-from utils import str2bool, read_lines
+from train import create_model, fliplr_images, forward_model, mixed_precision
+from utils import str2bool, read_lines, load_model_state
 
 cudnn.enabled = True
 cudnn.benchmark = True
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+image_input = Uint8ToFloat2d().to(device)
 
 
 def predict(model, data_loader, tta=False):
@@ -26,14 +28,14 @@ def predict(model, data_loader, tta=False):
     result = []
     with torch.no_grad():
         for batch in data_loader:
-            images = batch[0].to(device, non_blocking=True)
+            images = image_input(batch[0].to(device, non_blocking=True))
 
             if tta:
-                predictions1 = F.softmax(model(images), dim=1)
-                predictions2 = F.softmax(model(images.flip(3)), dim=1)
+                predictions1 = F.softmax(forward_model(model, images), dim=1)
+                predictions2 = F.softmax(forward_model(model, fliplr_images(images)), dim=1)
                 predictions = 0.5 * (predictions1 + predictions2)
             else:
-                predictions = F.softmax(model(images), dim=1)
+                predictions = F.softmax(forward_model(model, images), dim=1)
 
             prediction_scores, prediction_categories = predictions.topk(3, dim=1, sorted=True)
             prediction_scores = prediction_scores.cpu().data.numpy()
@@ -56,6 +58,10 @@ def main():
     base_model_dir = args.base_model_dir
     image_size = args.image_size
     augment = args.augment
+    direct_render = args.direct_render
+    uint8_images = args.uint8_images
+    stroke_sequence_len = args.stroke_sequence_len
+    use_mixed_precision = args.mixed_precision
     use_dummy_image = args.use_dummy_image
     use_progressive_image_sizes = args.use_progressive_image_sizes
     progressive_image_size_min = args.progressive_image_size_min
@@ -94,6 +100,11 @@ def main():
     max_sgdr_cycles = args.max_sgdr_cycles
 
     use_extended_stroke_channels = model_type in ["cnn", "residual_cnn", "fc_cnn", "hc_fc_cnn"]
+    use_stroke_sequences = model_type in ["stroke_cnn"]
+
+    if use_mixed_precision:
+        mixed_precision.enable()
+    print("precision: {}".format(mixed_precision.describe()), flush=True)
 
     base_model_dirs = [
         "/storage/models/quickdraw/l1",
@@ -112,9 +123,12 @@ def main():
     categories = read_lines("{}/categories.txt".format(input_dir))
 
     test_data = TestData(input_dir)
-    test_set = TestDataset(test_data.df, image_size, use_extended_stroke_channels)
-    test_set_data_loader = \
-        DataLoader(test_set, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=pin_memory)
+    test_set = TestDataset(
+        test_data.drawing, test_data.country, image_size, use_extended_stroke_channels, direct_render, uint8_images,
+        stroke_sequence_len if use_stroke_sequences else None)
+    test_set_data_loader = DataLoader(
+        test_set, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=pin_memory,
+        collate_fn=collate_stroke_sequences if use_stroke_sequences else None)
 
     all_model_predictions = []
     for base_model_dir in base_model_dirs:
@@ -123,7 +137,7 @@ def main():
         ms = []
         for model_file_path in glob.glob("{}/model-*.pth".format(base_model_dir)):
             m = create_model(type=model_type, input_size=image_size, num_classes=len(categories)).to(device)
-            m.load_state_dict(torch.load(model_file_path, map_location=device))
+            load_model_state(m, torch.load(model_file_path, map_location=device))
             ms.append(m)
         model = Ensemble(ms)
 
@@ -270,6 +284,10 @@ if __name__ == "__main__":
     argparser.add_argument("--base_model_dir", default=None)
     argparser.add_argument("--image_size", default=128, type=int)
     argparser.add_argument("--augment", default=False, type=str2bool)
+    argparser.add_argument("--direct_render", default=False, type=str2bool)
+    argparser.add_argument("--uint8_images", default=False, type=str2bool)
+    argparser.add_argument("--stroke_sequence_len", default=256, type=int)
+    argparser.add_argument("--mixed_precision", default=False, type=str2bool)
     argparser.add_argument("--use_dummy_image", default=False, type=str2bool)
     argparser.add_argument("--use_progressive_image_sizes", default=False, type=str2bool)
     argparser.add_argument("--progressive_image_size_min", default=32, type=int)
@@ -1,6 +1,8 @@
 import glob
+import json
 import math
 import os
+import re
 import shutil
 from multiprocessing import Pool
 
@@ -8,7 +10,11 @@ import h5py
 import numpy as np
 import pandas as pd
 
-from utils import draw_strokes, read_lines, flatten_strokes, flatten_stroke_lens
+from strokes import save_stroke_shard, countrycode_to_country, stroke_shard_exists, load_stroke_shard, \
+    flatten_drawing_batch, create_stroke_columns, select_stroke_columns, concatenate_stroke_columns, \
+    save_stroke_columns, key_id_to_shard, npz_to_stroke_shard, calculate_point_offset
+from utils import draw_strokes, read_lines, flatten_strokes, flatten_stroke_lens, draw_temporal_strokes_batch, \
+    image_cache_name, split_indexes, split_name
 
 
 def calculate_total_data_size():
@@ -141,6 +147,87 @@ def prepare_shards():
                 shard_df.to_csv(shard_file, header=write_csv_header)
 
 
+def category_csv_to_shard_pieces(category, categories, num_shards, pieces_dir_name, chunk_size):
+    csv_file_name = "/storage/kaggle/quickdraw/train_simplified/{}.csv".format(category)
+
+    print("processing file '{}'".format(csv_file_name), flush=True)
+
+    category_index_map = {c: i for i, c in enumerate(categories)}
+
+    chunks = pd.read_csv(
+        csv_file_name,
+        usecols=["key_id", "countrycode", "drawing", "recognized", "word"],
+        converters={"drawing": json.loads},
+        chunksize=chunk_size)
+
+    for c, df in enumerate(chunks):
+        columns = create_stroke_columns(
+            df.key_id.values,
+            [category_index_map[word] for word in df.word],
+            df.recognized.values,
+            countrycode_to_country(df.countrycode.values, "/storage/kaggle/quickdraw/countries.txt"),
+            df.drawing.values)
+
+        shard = key_id_to_shard(columns["key_id"], num_shards)
+        for s in range(num_shards):
+            shard_columns = select_stroke_columns(columns, np.flatnonzero(shard == s))
+            piece_file_name = "{}/shard-{}/{}-{}.npz".format(pieces_dir_name, s, category_index_map[category], c)
+            np.savez(piece_file_name, **shard_columns)
+
+    return None
+
+
+def merge_shard_pieces(shard, pieces_dir_name):
+    shard_pieces_dir_name = "{}/shard-{}".format(pieces_dir_name, shard)
+
+    columns_list = []
+    for piece_file_name in sorted(glob.glob("{}/*.npz".format(shard_pieces_dir_name))):
+        with np.load(piece_file_name) as piece_file:
+            columns_list.append({c: piece_file[c] for c in piece_file.files})
+    columns = concatenate_stroke_columns(columns_list)
+
+    # the pieces are ordered by category, the rows are shuffled so that any prefix of the shard is a random sample
+    indexes = np.random.RandomState(shard).permutation(len(columns["key_id"]))
+    columns = select_stroke_columns(columns, indexes)
+
+    strokes_dir_name = "/storage/kaggle/quickdraw/train_simplified_shards/shard-{}".format(shard)
+    print("writing directory '{}' with {} samples".format(strokes_dir_name, len(indexes)), flush=True)
+    save_stroke_columns(strokes_dir_name, columns)
+
+    shutil.rmtree(shard_pieces_dir_name)
+
+    return None
+
+
+def prepare_stroke_shards(num_shards=50, chunk_size=50000, num_workers=5):
+    # single pass over the category csv files, reading them in chunks and hashing every drawing to a shard by its key
+    # id; the per category pieces of every shard are merged into the final stroke shards in a second step, so the
+    # memory usage is bounded by the chunk size and the shard size rather than by the category size
+    shards_dir_name = "/storage/kaggle/quickdraw/train_simplified_shards"
+    pieces_dir_name = "{}/pieces".format(shards_dir_name)
+
+    if os.path.isdir(pieces_dir_name):
+        shutil.rmtree(pieces_dir_name)
+    for s in range(num_shards):
+        os.makedirs("{}/shard-{}".format(pieces_dir_name, s))
+        if os.path.isdir("{}/shard-{}".format(shards_dir_name, s)):
+            shutil.rmtree("{}/shard-{}".format(shards_dir_name, s))
+        # the image caches and splits of the previous shards don't match the new row order anymore
+        for file_name in glob.glob("{}/shard-{}-img*.npy".format(shards_dir_name, s)) + \
+                glob.glob("{}/shard-{}-split-*.npz".format(shards_dir_name, s)):
+            os.remove(file_name)
+
+    categories = read_lines("/storage/kaggle/quickdraw/categories.txt")
+
+    with Pool(num_workers) as pool:
+        pool.starmap(
+            category_csv_to_shard_pieces,
+            [(category, categories, num_shards, pieces_dir_name, chunk_size) for category in categories])
+        pool.starmap(merge_shard_pieces, [(s, pieces_dir_name) for s in range(num_shards)])
+
+    shutil.rmtree(pieces_dir_name)
+
+
 def csv_to_npz(csv_file_name):
     print("reading file '{}'".format(csv_file_name), flush=True)
 
@@ -157,10 +244,10 @@ def csv_to_npz(csv_file_name):
     df = df.rename(columns={"word": "category"})
 
     key_id = np.array(df.index.values, dtype=np.int64)
-    drawing = np.array(df.drawing.values, dtype=np.object)
+    drawing = np.array(df.drawing.values, dtype=object)
     category = np.array(df.category.values, dtype=np.int16)
-    recognized = np.array(df.recognized.values, dtype=np.bool)
-    countrycode = np.array(df.countrycode.values, dtype=np.object)
+    recognized = np.array(df.recognized.values, dtype=np.bool_)
+    countrycode = np.array(df.countrycode.values, dtype=object)
 
     npz_file_name = csv_file_name[:-4] + ".npz"
     print("writing file '{}'".format(npz_file_name), flush=True)
@@ -182,23 +269,147 @@ def convert_csv_to_npz():
         pool.map(csv_to_npz, csv_file_names)
 
 
-def draw_image(data_file_name):
-    print("reading file '{}'".format(data_file_name), flush=True)
+def csv_to_strokes(csv_file_name):
+    print("reading file '{}'".format(csv_file_name), flush=True)
+
+    categories = read_lines("/storage/kaggle/quickdraw/categories.txt")
+    category_index_map = {c: i for i, c in enumerate(categories)}
+
+    df = pd.read_csv(
+        csv_file_name,
+        index_col="key_id",
+        converters={"drawing": json.loads})
+
+    country = countrycode_to_country(df.countrycode.values, "/storage/kaggle/quickdraw/countries.txt")
+    category = [category_index_map[word] for word in df.word]
 
-    data = np.load(data_file_name)
-    data_drawing = data["drawing"]
-    data_image = np.array([draw_strokes(drawing, size=128) for drawing in data_drawing], dtype=np.uint8)
+    strokes_dir_name = csv_file_name[:-4]
+    print("writing directory '{}'".format(strokes_dir_name), flush=True)
+    save_stroke_shard(strokes_dir_name, df.index.values, category, df.recognized.values, country, df.drawing.values)
 
-    image_file_name = data_file_name[:-4] + "-img128.npy"
+    return None
+
+
+def convert_csv_to_strokes():
+    csv_file_names = glob.glob("/storage/kaggle/quickdraw/train_simplified_shards/*.csv")
+
+    with Pool(5) as pool:
+        pool.map(csv_to_strokes, csv_file_names)
+
+
+def convert_npz_to_strokes():
+    shards = [int(os.path.basename(n)[len("shard-"):]) for n in find_shard_names(stroke_dirs=False)]
+
+    with Pool(5) as pool:
+        pool.starmap(npz_to_stroke_shard, [("/storage/kaggle/quickdraw", s) for s in shards])
+
+
+def find_shard_names(shards_dir_name="/storage/kaggle/quickdraw/train_simplified_shards", stroke_dirs=True, npz=True):
+    # the shards (without extension) stored as complete stroke directories and/or as npz files; the anchored pattern
+    # skips the split, image cache and temporary files written next to the shards
+    shard_names = set()
+    for path in glob.glob("{}/shard-*".format(shards_dir_name)):
+        match = re.fullmatch(r"(shard-\d+)(\.npz)?", os.path.basename(path))
+        if match is None:
+            continue
+        shard_name = "{}/{}".format(shards_dir_name, match.group(1))
+        if match.group(2) is None and stroke_dirs and stroke_shard_exists(shard_name):
+            shard_names.add(shard_name)
+        elif match.group(2) is not None and npz:
+            shard_names.add(shard_name)
+    return sorted(shard_names)
+
+
+def draw_image_cache(shard_name, image_size, extended_channels, direct, chunk_size=1000):
+    print("reading shard '{}'".format(shard_name), flush=True)
+
+    if stroke_shard_exists(shard_name):
+        data_drawing = load_stroke_shard(shard_name)["drawing"]
+    else:
+        with np.load("{}.npz".format(shard_name), allow_pickle=True) as data_file:
+            data_drawing = data_file["drawing"]
+
+    num_channels = 6 if extended_channels else 3
+    image_file_name = "{}-{}.npy".format(shard_name, image_cache_name(image_size, extended_channels, direct))
     print("writing file '{}'".format(image_file_name), flush=True)
-    np.savez(image_file_name, image=data_image)
 
-def draw_images():
-    data_file_names = glob.glob("/storage/kaggle/quickdraw/train_simplified_shards/shard-0.npz")
+    # the images are written chunk by chunk into a memory mapped file to keep the memory usage bounded, and only renamed
+    # to their final name once complete so that a partially written file is never picked up for training
+    images = np.lib.format.open_memmap(
+        image_file_name + ".tmp",
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(data_drawing), num_channels, image_size, image_size))
+    for start in range(0, len(data_drawing), chunk_size):
+        end = min(start + chunk_size, len(data_drawing))
+        images[start:end] = draw_temporal_strokes_batch(
+            *flatten_drawing_batch(data_drawing, np.arange(start, end)),
+            size=image_size,
+            padding=3,
+            extended_channels=extended_channels,
+            direct=direct)
+    images.flush()
+    del images
+
+    os.rename(image_file_name + ".tmp", image_file_name)
+
+
+def draw_image_caches(image_size, extended_channels, direct=False):
+    shard_names = find_shard_names()
+
+    with Pool(5) as pool:
+        pool.starmap(draw_image_cache, [(n, image_size, extended_channels, direct) for n in shard_names])
+
+
+def save_split_indexes(shard_name, test_sizes, num_folds=3):
+    print("reading shard '{}'".format(shard_name), flush=True)
+
+    if stroke_shard_exists(shard_name):
+        data_category = np.array(load_stroke_shard(shard_name)["category"])
+    else:
+        with np.load("{}.npz".format(shard_name), allow_pickle=True) as data_file:
+            data_category = data_file["category"]
+
+    splits = [(test_size, None) for test_size in test_sizes] + [(None, fold) for fold in range(num_folds)]
+    for test_size, fold in splits:
+        train_indexes, val_indexes = split_indexes(data_category, test_size, fold, n_splits=num_folds)
+
+        split_file_name = "{}-{}.npz".format(shard_name, split_name(test_size, fold))
+        print("writing file '{}'".format(split_file_name), flush=True)
+        with open(split_file_name + ".tmp", "wb") as split_file:
+            np.savez(split_file, train=train_indexes.astype(np.int32), val=val_indexes.astype(np.int32))
+        os.rename(split_file_name + ".tmp", split_file_name)
+
+    return None
+
+
+def prepare_split_indexes(test_sizes=[0.1], num_folds=3):
+    shard_names = find_shard_names()
+
+    with Pool(5) as pool:
+        pool.starmap(save_split_indexes, [(n, test_sizes, num_folds) for n in shard_names])
+
+
+def save_point_offsets(shard_name):
+    # adds the point offsets to a stroke shard written before they were stored with the columns
+    point_offset_file_name = "{}/point_offset.npy".format(shard_name)
+    if os.path.isfile(point_offset_file_name):
+        return None
+
+    print("writing file '{}'".format(point_offset_file_name), flush=True)
+    with open(point_offset_file_name + ".tmp", "wb") as point_offset_file:
+        np.save(point_offset_file, calculate_point_offset(np.load("{}/stroke_len.npy".format(shard_name))))
+    os.rename(point_offset_file_name + ".tmp", point_offset_file_name)
+
+    return None
+
+
+def prepare_point_offsets():
+    shard_names = find_shard_names(npz=False)
 
     with Pool(5) as pool:
-        pool.map(draw_image, data_file_names)
+        pool.map(save_point_offsets, shard_names)
 
 
 if __name__ == "__main__":
-    draw_images()
+    draw_image_caches(image_size=128, extended_channels=False)
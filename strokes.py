@@ -0,0 +1,260 @@
+import glob
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from utils import flatten_drawings, read_lines, flatten_stroke_lens
+
+STROKE_COLUMNS = ["stroke_x", "stroke_y", "stroke_len", "drawing_offset"]
+DATA_COLUMNS = ["key_id", "category", "recognized", "country"]
+
+
+def concatenate_ranges(starts, counts):
+    # indexes of the concatenated ranges [starts[i], starts[i] + counts[i])
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) > 0 else 0, dtype=np.int64) \
+        + np.repeat(np.asarray(starts, dtype=np.int64) - (ends - counts), counts)
+
+
+# drawings stored as flat columns: the x/y points of all strokes back to back, the number of points per stroke and the
+# index of the first stroke of each drawing (with a trailing end offset); indexing with an int returns a single drawing
+# as a list of [x, y] arrays, indexing with an index array or a boolean mask returns a view on the selected drawings
+class StrokeDrawings:
+    def __init__(self, dir_name, indexes=None, columns=None, point_offset=None):
+        self.dir_name = dir_name
+        self.columns = columns
+        self.point_offset = point_offset
+        if indexes is None:
+            indexes = np.arange(len(self.get_columns()["drawing_offset"]) - 1)
+        self.indexes = indexes
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.get_drawing(self.indexes[index])
+        return StrokeDrawings(self.dir_name, self.indexes[index], self.columns, self.point_offset)
+
+    def __getstate__(self):
+        # the memory mapped files are reopened on first access after unpickling instead of being copied into the pickle
+        state = self.__dict__.copy()
+        state["columns"] = None
+        state["point_offset"] = None
+        return state
+
+    def get_columns(self):
+        if self.columns is None:
+            self.columns = {c: np.load("{}/{}.npy".format(self.dir_name, c), mmap_mode="r") for c in STROKE_COLUMNS}
+        return self.columns
+
+    def get_point_offset(self):
+        # the index of the first point of each stroke, memory mapped like the other columns so that all processes share
+        # it; it is only computed (per process) for shards written before it was stored with them
+        if self.point_offset is None:
+            point_offset_file_name = "{}/point_offset.npy".format(self.dir_name)
+            if os.path.isfile(point_offset_file_name):
+                self.point_offset = np.load(point_offset_file_name, mmap_mode="r")
+            else:
+                self.point_offset = calculate_point_offset(self.get_columns()["stroke_len"])
+        return self.point_offset
+
+    def get_drawing(self, d):
+        columns = self.get_columns()
+        point_offset = self.get_point_offset()
+        drawing = []
+        for s in range(columns["drawing_offset"][d], columns["drawing_offset"][d + 1]):
+            start, end = point_offset[s], point_offset[s + 1]
+            drawing.append([columns["stroke_x"][start:end], columns["stroke_y"][start:end]])
+        return drawing
+
+    def num_points(self):
+        drawing_offset = self.get_columns()["drawing_offset"]
+        point_offset = self.get_point_offset()
+        return point_offset[drawing_offset[self.indexes + 1]] - point_offset[drawing_offset[self.indexes]]
+
+    def flatten(self, indexes):
+        # same result as flatten_drawings for the selected drawings, gathered without building any python lists
+        columns = self.get_columns()
+        return gather_drawings(
+            columns["stroke_x"],
+            columns["stroke_y"],
+            columns["stroke_len"],
+            columns["drawing_offset"],
+            self.indexes[indexes],
+            self.get_point_offset())
+
+
+def calculate_point_offset(stroke_len):
+    point_offset = np.zeros(len(stroke_len) + 1, dtype=np.int64)
+    np.cumsum(stroke_len, out=point_offset[1:])
+    return point_offset
+
+
+def gather_drawings(stroke_x, stroke_y, stroke_len, drawing_offset, indexes, point_offset=None):
+    if point_offset is None:
+        point_offset = calculate_point_offset(stroke_len)
+
+    stroke_start = drawing_offset[indexes]
+    num_strokes = drawing_offset[np.asarray(indexes) + 1] - stroke_start
+    stroke_index = concatenate_ranges(stroke_start, num_strokes)
+
+    selected_stroke_len = stroke_len[stroke_index]
+    point_index = concatenate_ranges(point_offset[stroke_index], selected_stroke_len)
+
+    selected_drawing_offset = np.zeros(len(stroke_start) + 1, dtype=np.int32)
+    np.cumsum(num_strokes, out=selected_drawing_offset[1:])
+
+    return \
+        stroke_x[point_index], \
+        stroke_y[point_index], \
+        np.asarray(selected_stroke_len, dtype=np.int32), \
+        selected_drawing_offset
+
+
+def flatten_drawing_batch(drawings, indexes):
+    if isinstance(drawings, StrokeDrawings):
+        return drawings.flatten(indexes)
+    else:
+        return flatten_drawings([drawings[i] for i in indexes])
+
+
+def drawing_num_points(drawings):
+    if isinstance(drawings, StrokeDrawings):
+        return drawings.num_points()
+    else:
+        return np.array([sum(flatten_stroke_lens(d)) for d in drawings], dtype=np.int64)
+
+
+def stroke_shard_exists(dir_name, data_columns=DATA_COLUMNS):
+    return all(os.path.isfile("{}/{}.npy".format(dir_name, c)) for c in STROKE_COLUMNS + data_columns)
+
+
+def load_stroke_shard(dir_name):
+    data = {}
+    for c in DATA_COLUMNS:
+        if os.path.isfile("{}/{}.npy".format(dir_name, c)):
+            data[c] = np.load("{}/{}.npy".format(dir_name, c), mmap_mode="r")
+    data["drawing"] = StrokeDrawings(dir_name)
+    return data
+
+
+def create_stroke_columns(key_id, category, recognized, country, drawing):
+    # category and recognized are None for the test set
+    stroke_x, stroke_y, stroke_len, drawing_offset = flatten_drawings(drawing)
+    columns = {
+        "key_id": np.asarray(key_id, dtype=np.int64),
+        "country": np.asarray(country, dtype=np.uint8),
+        "stroke_x": stroke_x,
+        "stroke_y": stroke_y,
+        "stroke_len": stroke_len,
+        "drawing_offset": drawing_offset
+    }
+    if category is not None:
+        columns["category"] = np.asarray(category, dtype=np.int16)
+    if recognized is not None:
+        columns["recognized"] = np.asarray(recognized, dtype=np.bool_)
+    return columns
+
+
+def select_stroke_columns(columns, indexes):
+    selected_columns = {c: columns[c][indexes] for c in DATA_COLUMNS if c in columns}
+    selected_columns["stroke_x"], selected_columns["stroke_y"], selected_columns["stroke_len"], \
+        selected_columns["drawing_offset"] = gather_drawings(
+            columns["stroke_x"],
+            columns["stroke_y"],
+            columns["stroke_len"],
+            columns["drawing_offset"],
+            indexes)
+    return selected_columns
+
+
+def concatenate_stroke_columns(columns_list):
+    columns = {
+        c: np.concatenate([cl[c] for cl in columns_list])
+        for c in DATA_COLUMNS + STROKE_COLUMNS[:-1] if c in columns_list[0]
+    }
+
+    drawing_offsets = [np.zeros(1, dtype=np.int32)]
+    stroke_count = 0
+    for cl in columns_list:
+        drawing_offsets.append(cl["drawing_offset"][1:] + stroke_count)
+        stroke_count += cl["drawing_offset"][-1]
+    columns["drawing_offset"] = np.concatenate(drawing_offsets).astype(np.int32)
+
+    return columns
+
+
+def save_stroke_shard(dir_name, key_id, category, recognized, country, drawing, replace=True):
+    save_stroke_columns(dir_name, create_stroke_columns(key_id, category, recognized, country, drawing), replace)
+
+
+def save_stroke_columns(dir_name, columns, replace=True):
+    # the columns are written to a temporary directory of this writer which is renamed once complete, so that several
+    # processes converting the same shard on first use do not interfere: without replace, a shard written by another
+    # process in the meantime counts as success. With replace (a single writer per shard, as in prepare_data) the
+    # temporary directories of killed runs are removed first and an existing shard is replaced by the new one. The
+    # point offsets of the strokes are stored along with the columns
+    if "point_offset" not in columns:
+        columns = dict(columns, point_offset=calculate_point_offset(columns["stroke_len"]))
+
+    if replace:
+        for stale_dir_name in glob.glob("{}.tmp-*".format(dir_name)):
+            shutil.rmtree(stale_dir_name, ignore_errors=True)
+    elif os.path.isdir(dir_name):
+        return
+
+    tmp_dir_name = tempfile.mkdtemp(prefix=os.path.basename(dir_name) + ".tmp-", dir=os.path.dirname(dir_name))
+    # mkdtemp only grants access to the owner, the shard directory gets the usual permissions
+    os.chmod(tmp_dir_name, 0o755)
+    for c, values in columns.items():
+        np.save("{}/{}.npy".format(tmp_dir_name, c), values)
+
+    if replace and os.path.isdir(dir_name):
+        old_dir_name = tmp_dir_name + "-old"
+        os.rename(dir_name, old_dir_name)
+        os.rename(tmp_dir_name, dir_name)
+        shutil.rmtree(old_dir_name)
+        return
+
+    try:
+        os.rename(tmp_dir_name, dir_name)
+    except OSError:
+        if not os.path.isdir(dir_name):
+            raise
+        shutil.rmtree(tmp_dir_name)
+
+
+def npz_to_stroke_shard(data_dir, shard, replace=True):
+    # converts a training shard stored as an npz file into a stroke shard directory next to it
+    npz_file_name = "{}/train_simplified_shards/shard-{}.npz".format(data_dir, shard)
+    print("Converting data file '{}'".format(npz_file_name), flush=True)
+
+    # the drawings and country codes of the npz shards are object arrays
+    with np.load(npz_file_name, allow_pickle=True) as data_file:
+        key_id = data_file["key_id"]
+        drawing = data_file["drawing"]
+        category = data_file["category"]
+        recognized = data_file["recognized"]
+        countrycode = data_file["countrycode"]
+
+    country = countrycode_to_country(countrycode, "{}/countries.txt".format(data_dir))
+
+    save_stroke_shard(npz_file_name[:-4], key_id, category, recognized, country, drawing, replace)
+
+
+def key_id_to_shard(key_id, num_shards):
+    # fibonacci hashing of the key id, so that the shard of a drawing does not depend on the order of the input files
+    key_hash = np.asarray(key_id).astype(np.uint64) * np.uint64(11400714819323198485)
+    return ((key_hash >> np.uint64(32)) % np.uint64(num_shards)).astype(np.int32)
+
+
+def countrycode_to_country(countrycode, countries_file_name):
+    countries = read_lines(countries_file_name)
+    country_index_map = {c: i for i, c in enumerate(countries)}
+    # missing country codes are NaN and map to 255
+    return pd.Series(countrycode).map(country_index_map).fillna(255).values.astype(np.uint8)
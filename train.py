@@ -5,7 +5,8 @@ import os
 import shutil
 import sys
 import time
-from math import ceil
+from contextlib import nullcontext
+from functools import partial
 
 import numpy as np
 import psutil
@@ -15,30 +16,44 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from tensorboardX import SummaryWriter
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import CosineAnnealingLR, ReduceLROnPlateau
 from torch.utils.data import DataLoader
-
-from dataset import TrainDataProvider, TrainDataset, TestData, TestDataset, StratifiedSampler
-from metrics import accuracy, mapk, FocalLoss, CceCenterLoss, SoftCrossEntropyLoss, SoftBootstrapingLoss, \
-    HardBootstrapingLoss
+from torch.utils.data.dataloader import default_collate
+
+from augmentation import StrokeAugmentation
+from checkpoint_writer import CheckpointWriter
+from dataset import TrainDataProvider, TrainDataset, TestData, TestDataset, StratifiedSampler, PersistentDataLoader, \
+    StreamingTrainDataset, BucketBatchSampler, categories_to_one_hot, collate_stroke_sequences
+from distributed import init_distributed, cleanup_distributed, local_rank, get_rank, get_world_size, \
+    is_main_process, barrier, average_across_ranks, shared_random_seed, min_across_ranks, NullSummaryWriter
+from metrics import mapk, FocalLoss, CceCenterLoss, SoftCrossEntropyLoss, SoftBootstrapingLoss, \
+    HardBootstrapingLoss, MetricAccumulator, batch_loss, batch_mapk, batch_accuracy
 from metrics.smooth_topk_loss.svm import SmoothSVM
+from mixed_precision import MixedPrecision
 from models import ResNet, SimpleCnn, ResidualCnn, FcCnn, HcFcCnn, MobileNetV2, Drn, SeNet, NasNet, SeResNext50Cs, \
-    StackNet, AlexNetWrapper
+    StackNet, AlexNetWrapper, StrokeCnn
+from models.common import Uint8ToFloat2d, ResizeImage2d
 from models.ensemble import Ensemble
 from swa_utils import moving_average
-from utils import get_learning_rate, str2bool, adjust_learning_rate, adjust_initial_learning_rate
+from utils import get_learning_rate, str2bool, adjust_learning_rate, adjust_initial_learning_rate, image_cache_name, \
+    load_model_state, get_random_state, set_random_state
 
 cudnn.enabled = True
 cudnn.benchmark = True
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# with distributed training every process uses the gpu of its local rank
+device = torch.device("cuda:{}".format(local_rank()) if torch.cuda.is_available() else "cpu")
+image_input = Uint8ToFloat2d().to(device)
+image_resize = ResizeImage2d().to(device)
+mixed_precision = MixedPrecision(device)
 
 
 # class_weights = [0.0030502994322052983, 0.0024824986950179166, 0.002977493633314952, 0.0030123374143810142, 0.0027731585961971715, 0.0025069014123580632, 0.0025394718982390996, 0.0029114674846666745, 0.0024332506718945214, 0.003381818293745507, 0.002497043760670782, 0.002530821305942098, 0.006194950673417428, 0.0029696477472781362, 0.003040562486457045, 0.0027234277493176644, 0.0024907469341848253, 0.0023830973542284164, 0.0026916016167273004, 0.002376176880390815, 0.003507231764395526, 0.002513459768378581, 0.002711095625880311, 0.0033234770898820077, 0.0022906366049330225, 0.0024320234948477376, 0.00384486639351315, 0.0025890418038665695, 0.0025454267245644774, 0.002498411761313099, 0.0026871556146397715, 0.0029166980753578845, 0.0025781380340410462, 0.002572605678502266, 0.0024013239510216338, 0.0028704274653971783, 0.0030821658001086716, 0.0026209886423959614, 0.002402370069159876, 0.002877488762830312, 0.002425585844766248, 0.0026758494916841553, 0.0026721478428872987, 0.0023522972221197897, 0.002495876936593512, 0.0037702298878808803, 0.0033437154523256905, 0.002424579961941015, 0.00237386334989278, 0.0026490125379069456, 0.002512795885713927, 0.00258260415378508, 0.006477503159025307, 0.0024422633820086067, 0.0025905908634174277, 0.003474520454918957, 0.0026835947894384474, 0.0028475536899513856, 0.0028445159238191828, 0.0024899019926116297, 0.003676783373416758, 0.0026647646629500907, 0.00246509692214139, 0.0024785355166864996, 0.002321839090171742, 0.003012116120159463, 0.0024368517324088548, 0.004480322809525686, 0.003369747699842714, 0.00330382213947696, 0.002471977160665982, 0.00253912989807852, 0.0024249018444450895, 0.002419449959532328, 0.0036902219679618674, 0.002567194028902514, 0.0024922758760791788, 0.002642514534855942, 0.005460817152249559, 0.0024073190126600212, 0.002476141515562446, 0.0025535341401358535, 0.0026143498157494252, 0.0025736920319535178, 0.002697556443052678, 0.002482719989239468, 0.002629800175945, 0.0026472220664780313, 0.0034151532505737204, 0.005838928506254549, 0.003061082496091793, 0.002446568560500603, 0.0028315802706866894, 0.0024187458415546653, 0.0025018719982318996, 0.002482418224391898, 0.0027518137626457327, 0.0027621341204326203, 0.002725540103250653, 0.0031780867863228663, 0.00247239963145258, 0.002539914486682202, 0.0025543187287395347, 0.002713127509187281, 0.0023807033531043627, 0.002532571542058003, 0.004541802367803912, 0.003252341056481548, 0.0027391798743608095, 0.0024123081914731756, 0.002603747810771472, 0.003378901233552332, 0.002760987414011855, 0.0031297038224291714, 0.004439866202294825, 0.002698783620099462, 0.002506036353128363, 0.004823469676525586, 0.002444657383132661, 0.0033466727478318747, 0.0029133987796911213, 0.003057199788386395, 0.004085614388904356, 0.002536373779137383, 0.0031996529140958566, 0.002491048699032395, 0.003189191732713436, 0.0024511956214966738, 0.0025586037895750265, 0.0038223949711974504, 0.0039197845463364855, 0.0031243726434554376, 0.0024759001036843897, 0.0024231918436421938, 0.002608696754271617, 0.0023942425359319954, 0.00586978899133269, 0.005741639519398038, 0.004478391514501239, 0.002392110064342502, 0.0024247207855365477, 0.003217577746041504, 0.0024523222102609344, 0.002865458404240528, 0.004089939685052857, 0.002617508287820656, 0.003586696507588913, 0.0033686613463914626, 0.0025418658993631533, 0.003661393366190697, 0.0024197316067233934, 0.0027351362254033735, 0.002724333043860374, 0.002474391279446541, 0.002740930110476714, 0.0024771473983876786, 0.0043076730814027376, 0.0024167541935607045, 0.00350992753036715, 0.0032382385792717847, 0.003777411891253042, 0.005382277821255386, 0.00252253283146218, 0.0030158781219258336, 0.005260787293623775, 0.0025261942449460273, 0.0023498227503697174, 0.002431802200626186, 0.003236991284568496, 0.0030490320198455047, 0.002887869473586714, 0.002433210436581512, 0.002567475676093579, 0.002819992500540008, 0.0025921399229682862, 0.0026163615813998907, 0.0024267727865000224, 0.006420268426269564, 0.002896318889318669, 0.0027628382384102834, 0.003627293938415307, 0.002425585844766248, 0.002626018056522125, 0.0025676768526586256, 0.0024475342080128265, 0.002475055162111194, 0.003418613487492521, 0.0025859235671083476, 0.003597560042101427, 0.003619649228943538, 0.0026984818552518923, 0.0030763517973788263, 0.002860066872297281, 0.003190519498042743, 0.0024257870213312944, 0.003974705748594193, 0.0026453310067665937, 0.0032082431534233443, 0.003020706359486951, 0.0026615056025963363, 0.004162544307378157, 0.003412598308197629, 0.0037620420016834855, 0.0024834442248736354, 0.0024535292696512136, 0.0022856273084633635, 0.0029022535979875423, 0.00255753755378028, 0.0025613599085161642, 0.0037324288113086334, 0.0030229796546719766, 0.002547418372558438, 0.002351834516020183, 0.0032521398799165015, 0.002454374211224409, 0.005105680161972885, 0.0023511505156990245, 0.002630182411418589, 0.0024618177441311315, 0.003757374705374406, 0.00238903206289729, 0.0025161354166936996, 0.002622758996168371, 0.003471281512221708, 0.002615778169361256, 0.0024467093840961356, 0.0026844799663246523, 0.0025490479027353154, 0.0025289101285741558, 0.00662281299195843, 0.003409178306591838, 0.002480909400154049, 0.0031240306432948587, 0.0024058303060786766, 0.0027305292820638074, 0.002709445978046929, 0.0025518241393329578, 0.0031109742842233374, 0.002406956894842937, 0.0037918563686233846, 0.0026811002000318705, 0.0028882919443733116, 0.002409531954875533, 0.0027461808188244292, 0.002650139126671206, 0.002439386557128441, 0.0023760360567952827, 0.0024551789174845954, 0.0024823176361093748, 0.0033332743885997745, 0.0023399449810259315, 0.002411624191152017, 0.002654243128598156, 0.002535830602411757, 0.0025372589560235873, 0.00241876595921117, 0.0025141035333867295, 0.0023576686364065328, 0.004192720792135139, 0.002589806274813746, 0.0025383251918183343, 0.003695794558813657, 0.002407902424698656, 0.002502354821988011, 0.0026908773810931327, 0.0024598462137936754, 0.003108841812633844, 0.0023474287492456633, 0.00684058662362132, 0.0025217281252019937, 0.004138503707855094, 0.0037937876636478314, 0.004213582801930466, 0.002515270357464, 0.003424025137092273, 0.0025176241232750442, 0.0023827553540678374, 0.003156118305419783, 0.002594795453626901, 0.00276857177051411, 0.0024551990351411, 0.002463286333055971, 0.003093974864476904, 0.002518569653130763, 0.0024103768964487287, 0.002344411100769965, 0.0024604095081758055, 0.002480104693893863, 0.002395670889543826, 0.0025018719982318996, 0.0025437167237615816, 0.0026913602048492446, 0.0030596541424799625, 0.002417820429355451, 0.0024011831274261012, 0.0024906061105892927, 0.0025754825033824317, 0.002550999315416267, 0.0036124873432278807, 0.002572746502097799, 0.002477227869013697, 0.004650216418707497, 0.002646015007087752, 0.0027118802144839925, 0.003883009470245976, 0.0024419414995045323, 0.0024355843200490612, 0.0024630851564909247, 0.003091118157253243, 0.002613042168076623, 0.002515994593098167, 0.0025112468261630685, 0.0026361573554004713, 0.00288227676507842, 0.002347267807993626, 0.0025211648308198636, 0.002574013914457592, 0.00291144736701017, 0.0024778917516783505, 0.0037169180981435446, 0.002642534652512447, 0.0034108883073947333, 0.002519394477047454, 0.0024962792897236055, 0.002505613882341765, 0.003337700273030799, 0.0025443806064262353, 0.0043707620522013355, 0.002431238906244056, 0.002674421138072325, 0.003729089280328861, 0.0023437472181053113, 0.0027492588202696414, 0.002427074551347592, 0.0025423286054627606, 0.0026616061908788595, 0.003272036242199605, 0.005641835825478445, 0.0029091740718251435, 0.0024155672518269295]
 # class_weights = torch.tensor(class_weights).to(device)
 
 
-def create_model(type, input_size, num_classes):
+def create_model(type, input_size, num_classes, distributed=False):
     if type == "resnet":
         model = ResNet(num_classes=num_classes)
     elif type in ["seresnext50", "seresnext101", "seresnet50", "seresnet101", "seresnet152", "senet154"]:
@@ -63,9 +78,15 @@ def create_model(type, input_size, num_classes):
         model = SeResNext50Cs(num_classes=num_classes)
     elif type == "stack":
         model = StackNet(num_classes=num_classes)
+    elif type == "stroke_cnn":
+        model = StrokeCnn(num_classes=num_classes)
     else:
         raise Exception("Unsupported model type: '{}".format(type))
 
+    if distributed:
+        model = model.to(device)
+        return DistributedDataParallel(model, device_ids=[device.index] if device.type == "cuda" else None)
+
     return nn.DataParallel(model)
 
 
@@ -73,48 +94,76 @@ def zero_item_tensor():
     return torch.tensor(0.0).float().to(device, non_blocking=True)
 
 
+def images_to_device(images):
+    return image_resize(image_input(images.to(device, non_blocking=True)))
+
+
+def forward_model(model, images):
+    # the forward pass runs in mixed precision if enabled, while the logits are always returned as fp32 so that the
+    # losses and metrics are computed in full precision
+    with mixed_precision.autocast():
+        return model(images).float()
+
+
+def fliplr_images(images):
+    # the x channel of the stroke sequences is flipped within the valid points, the padding stays zero
+    if images.dim() == 3:
+        images = images.clone()
+        images[:, 0] = images[:, -1] - images[:, 0]
+        return images
+    return images.flip(3)
+
+
+def batch_to_device(batch, num_categories):
+    images = images_to_device(batch[0])
+    categories = batch[1].to(device, non_blocking=True)
+    if len(batch) > 2:
+        categories_one_hot = batch[2].to(device, non_blocking=True)
+    else:
+        categories_one_hot = categories_to_one_hot(categories, num_categories)
+    return images, categories, categories_one_hot
+
+
 def evaluate(model, data_loader, criterion, mapk_topk):
     model.eval()
 
-    loss_sum_t = zero_item_tensor()
-    mapk_sum_t = zero_item_tensor()
-    accuracy_top1_sum_t = zero_item_tensor()
-    accuracy_top3_sum_t = zero_item_tensor()
-    accuracy_top5_sum_t = zero_item_tensor()
-    accuracy_top10_sum_t = zero_item_tensor()
-    step_count = 0
+    num_categories = data_loader.dataset.num_categories
+    metrics = create_eval_metrics(mapk_topk, num_categories)
 
     with torch.no_grad():
         for batch in data_loader:
-            images, categories, categories_one_hot = \
-                batch[0].to(device, non_blocking=True), \
-                batch[1].to(device, non_blocking=True), \
-                batch[2].to(device, non_blocking=True)
+            images, categories, categories_one_hot = batch_to_device(batch, num_categories)
 
-            prediction_logits = model(images)
+            prediction_logits = forward_model(model, images)
             # if prediction_logits.size(1) == len(class_weights):
             #     criterion.weight = class_weights
             loss = criterion(prediction_logits, get_loss_target(criterion, categories, categories_one_hot))
 
-            num_categories = prediction_logits.size(1)
+            metrics.update(prediction_logits, categories, loss)
 
-            loss_sum_t += loss
-            mapk_sum_t += mapk(prediction_logits, categories, topk=min(mapk_topk, num_categories))
-            accuracy_top1_sum_t += accuracy(prediction_logits, categories, topk=min(1, num_categories))
-            accuracy_top3_sum_t += accuracy(prediction_logits, categories, topk=min(3, num_categories))
-            accuracy_top5_sum_t += accuracy(prediction_logits, categories, topk=min(5, num_categories))
-            accuracy_top10_sum_t += accuracy(prediction_logits, categories, topk=min(10, num_categories))
+    results = metrics.results()
 
-            step_count += 1
+    # with distributed training every rank evaluates its own slice of the validation set, the averages of all ranks
+    # are the same on every rank, so that all of them take the same decisions based on them
+    return tuple(average_across_ranks([
+        results["loss"],
+        results["mapk"],
+        results["accuracy@1"],
+        results["accuracy@3"],
+        results["accuracy@5"],
+        results["accuracy@10"]
+    ]))
 
-    loss_avg = loss_sum_t.item() / step_count
-    mapk_avg = mapk_sum_t.item() / step_count
-    accuracy_top1_avg = accuracy_top1_sum_t.item() / step_count
-    accuracy_top3_avg = accuracy_top3_sum_t.item() / step_count
-    accuracy_top5_avg = accuracy_top5_sum_t.item() / step_count
-    accuracy_top10_avg = accuracy_top10_sum_t.item() / step_count
 
-    return loss_avg, mapk_avg, accuracy_top1_avg, accuracy_top3_avg, accuracy_top5_avg, accuracy_top10_avg
+def create_eval_metrics(mapk_topk, num_categories):
+    # all the metrics are derived from a single top k per batch, further ones (e.g. per category breakdowns) can be
+    # registered without another pass over the predictions
+    metrics = MetricAccumulator(topk=min(max(mapk_topk, 10), num_categories))
+    metrics.register("loss", batch_loss)
+    metrics.register("mapk", partial(batch_mapk, topk=mapk_topk))
+    for k in [1, 3, 5, 10]:
+        metrics.register("accuracy@{}".format(k), partial(batch_accuracy, topk=k))
+    return metrics
 
 
 def create_criterion(loss_type, num_classes, bootstraping_loss_ratio):
@@ -162,14 +211,14 @@ def predict(model, data_loader, categories, tta=False):
     predicted_words = []
     with torch.no_grad():
         for batch in data_loader:
-            images = batch[0].to(device, non_blocking=True)
+            images = images_to_device(batch[0])
 
             if tta:
-                predictions1 = F.softmax(model(images), dim=1)
-                predictions2 = F.softmax(model(images.flip(3)), dim=1)
+                predictions1 = F.softmax(forward_model(model, images), dim=1)
+                predictions2 = F.softmax(forward_model(model, fliplr_images(images)), dim=1)
                 predictions = 0.5 * (predictions1 + predictions2)
             else:
-                predictions = F.softmax(model(images), dim=1)
+                predictions = F.softmax(forward_model(model, images), dim=1)
 
             _, prediction_categories = predictions.topk(3, dim=1, sorted=True)
 
@@ -188,10 +237,10 @@ def calculate_confusion(model, data_loader, num_categories, scale=True):
     with torch.no_grad():
         for batch in data_loader:
             images, categories = \
-                batch[0].to(device, non_blocking=True), \
+                images_to_device(batch[0]), \
                 batch[1].to(device, non_blocking=True)
 
-            predictions = F.softmax(model(images), dim=1)
+            predictions = F.softmax(forward_model(model, images), dim=1)
             _, prediction_categories = predictions.topk(3, dim=1, sorted=True)
 
             for bpc, bc in zip(prediction_categories[:, 0], categories):
@@ -221,7 +270,7 @@ def load_ensemble_model(base_dir, ensemble_model_count, data_loader, criterion,
     for model_file_path in ensemble_model_candidates:
         model_file_name = os.path.basename(model_file_path)
         model = create_model(type=model_type, input_size=input_size, num_classes=num_classes).to(device)
-        model.load_state_dict(torch.load(model_file_path, map_location=device))
+        load_model_state(model, torch.load(model_file_path, map_location=device))
 
         val_loss_avg, val_mapk_avg, _, _, _, _ = evaluate(model, data_loader, criterion, 3)
         print("ensemble '%s': val_loss=%.4f, val_mapk=%.4f" % (model_file_name, val_loss_avg, val_mapk_avg))
@@ -239,12 +288,87 @@ def load_ensemble_model(base_dir, ensemble_model_count, data_loader, criterion,
     return ensemble
 
 
+def create_data_loader(dataset, batch_size, num_workers, pin_memory, persistent_workers, sampler=None,
+                       collate_fn=None, batch_sampler=None):
+    if persistent_workers:
+        return PersistentDataLoader(
+            dataset, batch_size, sampler=sampler, num_workers=num_workers, pin_memory=pin_memory,
+            collate_fn=collate_fn if collate_fn is not None else default_collate, batch_sampler=batch_sampler)
+    elif batch_sampler is not None:
+        return DataLoader(
+            dataset, batch_sampler=batch_sampler, num_workers=num_workers, pin_memory=pin_memory,
+            collate_fn=collate_fn)
+    else:
+        return DataLoader(
+            dataset, batch_size=batch_size, shuffle=False, sampler=sampler, num_workers=num_workers,
+            pin_memory=pin_memory, collate_fn=collate_fn)
+
+
+def close_data_loaders(*data_loaders):
+    for data_loader in data_loaders:
+        if isinstance(data_loader, PersistentDataLoader):
+            data_loader.close()
+
+
+def warmup_model(model, batch_size, num_channels, image_size):
+    # runs a training step on random images so that cudnn autotunes the new input shape before the epoch starts, the
+    # batch norm statistics are restored and the gradients are cleared afterwards
+    start_time = time.time()
+
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    model.train()
+    images = torch.rand((batch_size, num_channels, image_size, image_size), device=device)
+    forward_model(model, images).sum().backward()
+    model.load_state_dict(state)
+    model.zero_grad(set_to_none=True)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+    print("Time to warm up image size {}: {}".format(
+        image_size, str(datetime.timedelta(seconds=time.time() - start_time))),
+        flush=True)
+
+
+def compare_precision_throughputs(model, batch_size, input_shape, num_steps=5):
+    # times training steps (forward and backward) on random inputs in fp32 and in mixed precision, like in warmup_model
+    # the model state is restored and the gradients are cleared afterwards
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    model.train()
+    inputs = torch.rand((batch_size,) + tuple(input_shape), device=device)
+    if len(input_shape) == 2:
+        # the validity channel of the stroke sequences
+        inputs[:, -1] = 1
+
+    throughputs = []
+    for dtype in [None, mixed_precision.dtype]:
+        for step in range(num_steps + 1):
+            # the first step is not timed, it includes the cudnn autotuning
+            if step == 1:
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                start_time = time.time()
+            with torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+                logits = model(inputs)
+            logits.float().sum().backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        throughputs.append(num_steps * batch_size / (time.time() - start_time))
+    model.load_state_dict(state)
+    model.zero_grad(set_to_none=True)
+
+    print("Training throughput fp32: {:.0f} samples/s, {}: {:.0f} samples/s ({:.2f}x)".format(
+        throughputs[0], mixed_precision.describe(), throughputs[1], throughputs[1] / throughputs[0]),
+        flush=True)
+
+
 def check_model_improved(old_score, new_score, threshold=1e-4):
     return new_score - old_score > threshold
 
 
 def main():
     args = argparser.parse_args()
+    if args.distributed:
+        init_distributed(args.distributed_backend)
     print("Arguments:")
     for arg in vars(args):
         print("  {}: {}".format(arg, getattr(args, arg)))
@@ -253,13 +377,28 @@ def main():
     input_dir = args.input_dir
     output_dir = args.output_dir
     base_model_dir = args.base_model_dir
+    resume = args.resume
+    save_train_state = args.save_train_state
     image_size = args.image_size
     augment = args.augment
+    augment_scale = args.augment_scale
+    augment_shift = args.augment_shift
+    augment_rotate = args.augment_rotate
+    augment_stroke_dropout = args.augment_stroke_dropout
+    augment_point_jitter = args.augment_point_jitter
+    augment_partition_jitter = args.augment_partition_jitter
+    direct_render = args.direct_render
+    uint8_images = args.uint8_images
+    stroke_sequence_len = args.stroke_sequence_len
+    bucket_sequence_lens = args.bucket_sequence_lens
+    num_sequence_len_buckets = args.num_sequence_len_buckets
+    use_image_cache = args.use_image_cache
     use_dummy_image = args.use_dummy_image
     use_progressive_image_sizes = args.use_progressive_image_sizes
     progressive_image_size_min = args.progressive_image_size_min
     progressive_image_size_step = args.progressive_image_size_step
     progressive_image_epoch_step = args.progressive_image_epoch_step
+    progressive_image_device_resize = args.progressive_image_device_resize
     batch_size = args.batch_size
     batch_iterations = args.batch_iterations
     test_size = args.test_size
@@ -273,8 +412,16 @@ def main():
     mapk_topk = args.mapk_topk
     num_shard_preload = args.num_shard_preload
     num_shard_loaders = args.num_shard_loaders
+    adaptive_shard_preload = args.adaptive_shard_preload
+    max_shard_preload = args.max_shard_preload
+    shard_preload_memory_budget = args.shard_preload_memory_budget
     num_workers = args.num_workers
     pin_memory = args.pin_memory
+    persistent_workers = args.persistent_workers
+    stream_shards = args.stream_shards
+    num_stream_shards = args.num_stream_shards
+    stream_reservoir_size = args.stream_reservoir_size
+    stream_epoch_size = args.stream_epoch_size
     epochs_to_train = args.epochs
     lr_scheduler_type = args.lr_scheduler
     lr_patience = args.lr_patience
@@ -288,18 +435,43 @@ def main():
     loss2_type = args.loss2
     loss2_start_sgdr_cycle = args.loss2_start_sgdr_cycle
     model_type = args.model
+    use_mixed_precision = args.mixed_precision
     patience = args.patience
     sgdr_cycle_epochs = args.sgdr_cycle_epochs
     sgdr_cycle_epochs_mult = args.sgdr_cycle_epochs_mult
     sgdr_cycle_end_prolongation = args.sgdr_cycle_end_prolongation
     sgdr_cycle_end_patience = args.sgdr_cycle_end_patience
     max_sgdr_cycles = args.max_sgdr_cycles
+    distributed = args.distributed
+
+    if distributed:
+        print("distributed training: rank {} of {} ranks".format(get_rank(), get_world_size()), flush=True)
 
     use_extended_stroke_channels = model_type in ["cnn", "residual_cnn", "fc_cnn", "hc_fc_cnn"]
     print("use_extended_stroke_channels: {}".format(use_extended_stroke_channels), flush=True)
 
+    # the sequence models are fed with the stroke sequences instead of the rendered images
+    use_stroke_sequences = model_type in ["stroke_cnn"]
+    print("use_stroke_sequences: {}".format(use_stroke_sequences), flush=True)
+    sequence_len = stroke_sequence_len if use_stroke_sequences else None
+    collate_fn = collate_stroke_sequences if use_stroke_sequences else None
+    if use_stroke_sequences:
+        use_image_cache = False
+        use_progressive_image_sizes = False
+
     progressive_image_sizes = list(range(progressive_image_size_min, image_size + 1, progressive_image_size_step))
 
+    # the full state of an interrupted training in the same output dir, which continues with the epoch following the
+    # last saved one
+    train_state_file_path = "{}/train_state.pth".format(output_dir)
+    train_state = None
+    if resume:
+        if os.path.isfile(train_state_file_path):
+            train_state = torch.load(train_state_file_path, map_location="cpu")
+            print("resuming the training after epoch {}".format(train_state["epoch"] + 1), flush=True)
+        else:
+            print("no training state found in '{}', starting a new training".format(output_dir), flush=True)
+
     train_data_provider = TrainDataProvider(
         input_dir,
         50,
@@ -311,35 +483,101 @@ def main():
         confusion_set=confusion_set,
         num_category_shards=num_category_shards,
         category_shard=category_shard,
-        train_on_val=train_on_val)
+        train_on_val=train_on_val,
+        image_cache_name=image_cache_name(image_size, use_extended_stroke_channels, direct_render) if use_image_cache else None,
+        adaptive_preload=adaptive_shard_preload,
+        max_shard_preload=max_shard_preload,
+        preload_memory_budget=shard_preload_memory_budget * 2 ** 30 if shard_preload_memory_budget is not None else None,
+        rank=get_rank(),
+        num_ranks=get_world_size(),
+        seed=shared_random_seed() if distributed else None,
+        shards=train_state["data"]["shards"] if train_state is not None else None,
+        shard_index=train_state["data"]["shard_index"] if train_state is not None else 0)
 
     train_data = train_data_provider.get_next()
 
-    train_set = TrainDataset(train_data.train_set_df, len(train_data.categories), image_size, use_extended_stroke_channels, augment, use_dummy_image)
-    stratified_sampler = StratifiedSampler(train_data.train_set_df["category"], batch_size * batch_iterations)
-    train_set_data_loader = \
-        DataLoader(train_set, batch_size=batch_size, shuffle=False, sampler=stratified_sampler, num_workers=num_workers,
-                   pin_memory=pin_memory)
-
-    val_set = TrainDataset(train_data.val_set_df, len(train_data.categories), image_size, use_extended_stroke_channels, False, use_dummy_image)
-    val_set_data_loader = \
-        DataLoader(val_set, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=pin_memory)
+    augmentation = StrokeAugmentation(
+        scale=augment_scale,
+        shift=augment_shift,
+        rotate=augment_rotate,
+        stroke_dropout=augment_stroke_dropout,
+        point_jitter=augment_point_jitter,
+        partition_jitter=augment_partition_jitter)
 
-    if base_model_dir:
-        for base_file_path in glob.glob("{}/*.pth".format(base_model_dir)):
-            shutil.copyfile(base_file_path, "{}/{}".format(output_dir, os.path.basename(base_file_path)))
-        model = create_model(type=model_type, input_size=image_size, num_classes=len(train_data.categories)).to(device)
-        model.load_state_dict(torch.load("{}/model.pth".format(output_dir), map_location=device))
+    stratified_sampler = StratifiedSampler(train_data.train_set_df["category"], batch_size * batch_iterations)
+    if stream_shards:
+        train_set = StreamingTrainDataset(
+            train_data_provider.shard_loader(),
+            train_data_provider.shards,
+            num_stream_shards,
+            stream_reservoir_size,
+            stream_epoch_size,
+            batch_size,
+            len(train_data.categories),
+            image_size,
+            use_extended_stroke_channels,
+            augment,
+            use_dummy_image,
+            direct_render,
+            uint8_images,
+            augmentation,
+            sequence_len)
+        train_set_data_loader = DataLoader(
+            train_set, batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory, collate_fn=collate_fn)
+    else:
+        train_set = TrainDataset(train_data.train_set_df, len(train_data.categories), image_size, use_extended_stroke_channels, augment, use_dummy_image, direct_render, uint8_images, augmentation, sequence_len)
+        if use_stroke_sequences and bucket_sequence_lens:
+            bucket_batch_sampler = BucketBatchSampler(
+                train_data.train_set_df["category"], train_set.sequence_lens(), batch_size, num_sequence_len_buckets)
+            train_set_data_loader = create_data_loader(
+                train_set, batch_size, num_workers, pin_memory, persistent_workers, collate_fn=collate_fn,
+                batch_sampler=bucket_batch_sampler)
+        else:
+            train_set_data_loader = create_data_loader(
+                train_set, batch_size, num_workers, pin_memory, persistent_workers, sampler=stratified_sampler,
+                collate_fn=collate_fn)
+
+    val_set = TrainDataset(train_data.val_set_df, len(train_data.categories), image_size, use_extended_stroke_channels, False, use_dummy_image, direct_render, uint8_images, sequence_len=sequence_len)
+    val_set_data_loader = create_data_loader(
+        val_set, batch_size, num_workers, pin_memory, persistent_workers, collate_fn=collate_fn)
+
+    if train_state is not None:
+        # the optimizer state is only restored below, after the lr schedulers are created
+        model = create_model(
+            type=model_type, input_size=image_size, num_classes=len(train_data.categories), distributed=distributed
+        ).to(device)
+        load_model_state(model, train_state["model"])
+        optimizer = create_optimizer(optimizer_type, model, lr_max)
+    elif base_model_dir:
+        if is_main_process():
+            for base_file_path in glob.glob("{}/*.pth".format(base_model_dir)):
+                shutil.copyfile(base_file_path, "{}/{}".format(output_dir, os.path.basename(base_file_path)))
+        barrier()
+        model = create_model(
+            type=model_type, input_size=image_size, num_classes=len(train_data.categories), distributed=distributed
+        ).to(device)
+        load_model_state(model, torch.load("{}/model.pth".format(output_dir), map_location=device))
         optimizer = create_optimizer(optimizer_type, model, lr_max)
         if os.path.isfile("{}/optimizer.pth".format(output_dir)):
             optimizer.load_state_dict(torch.load("{}/optimizer.pth".format(output_dir)))
             adjust_initial_learning_rate(optimizer, lr_max)
             adjust_learning_rate(optimizer, lr_max)
     else:
-        model = create_model(type=model_type, input_size=image_size, num_classes=len(train_data.categories)).to(device)
+        model = create_model(
+            type=model_type, input_size=image_size, num_classes=len(train_data.categories), distributed=distributed
+        ).to(device)
         optimizer = create_optimizer(optimizer_type, model, lr_max)
 
-    torch.save(model.state_dict(), "{}/model.pth".format(output_dir))
+    # only the first rank writes checkpoints and logs, the models of all ranks are the same
+    checkpoint_writer = CheckpointWriter()
+    if is_main_process() and train_state is None:
+        checkpoint_writer.save(model.state_dict(), "{}/model.pth".format(output_dir))
+
+    if use_mixed_precision and mixed_precision.enable():
+        input_shape = (4, stroke_sequence_len) if use_stroke_sequences \
+            else (6 if use_extended_stroke_channels else 3, image_size, image_size)
+        compare_precision_throughputs(model, batch_size, input_shape)
+    print("precision: {}".format(mixed_precision.describe()), flush=True)
 
     ensemble_model_index = 0
     for model_file_path in glob.glob("{}/model-*.pth".format(output_dir)):
@@ -347,13 +585,11 @@ def main():
         model_index = int(model_file_name.replace("model-", "").replace(".pth", ""))
         ensemble_model_index = max(ensemble_model_index, model_index + 1)
 
-    if confusion_set is not None:
+    if confusion_set is not None and is_main_process():
         shutil.copyfile(
             "/storage/models/quickdraw/seresnext50_confusion/confusion_set_{}.txt".format(confusion_set),
             "{}/confusion_set.txt".format(output_dir))
 
-    epoch_iterations = ceil(len(train_set) / batch_size)
-
     print("train_set_samples: {}, val_set_samples: {}".format(len(train_set), len(val_set)), flush=True)
     print()
 
@@ -362,9 +598,14 @@ def main():
 
     lr_scheduler = CosineAnnealingLR(optimizer, T_max=sgdr_cycle_epochs, eta_min=lr_min)
 
-    optim_summary_writer = SummaryWriter(log_dir="{}/logs/optim".format(output_dir))
-    train_summary_writer = SummaryWriter(log_dir="{}/logs/train".format(output_dir))
-    val_summary_writer = SummaryWriter(log_dir="{}/logs/val".format(output_dir))
+    if is_main_process():
+        optim_summary_writer = SummaryWriter(log_dir="{}/logs/optim".format(output_dir))
+        train_summary_writer = SummaryWriter(log_dir="{}/logs/train".format(output_dir))
+        val_summary_writer = SummaryWriter(log_dir="{}/logs/val".format(output_dir))
+    else:
+        optim_summary_writer = NullSummaryWriter()
+        train_summary_writer = NullSummaryWriter()
+        val_summary_writer = NullSummaryWriter()
 
     current_sgdr_cycle_epochs = sgdr_cycle_epochs
     sgdr_next_cycle_end_epoch = current_sgdr_cycle_epochs + sgdr_cycle_end_prolongation
@@ -388,6 +629,11 @@ def main():
     print('{"chart": "lr_scaled", "axis": "epoch"}')
     print('{"chart": "mem_used", "axis": "epoch"}')
     print('{"chart": "epoch_time", "axis": "epoch"}')
+    print('{"chart": "shard_stall_time", "axis": "epoch"}')
+    print('{"chart": "throughput", "axis": "epoch"}')
+    print('{"chart": "checkpoint_stall_time", "axis": "epoch"}')
+    if use_stroke_sequences:
+        print('{"chart": "padding_efficiency", "axis": "epoch"}')
 
     train_start_time = time.time()
 
@@ -396,7 +642,41 @@ def main():
     if loss_type == "center":
         optimizer_centloss = torch.optim.SGD(criterion.center.parameters(), lr=0.01)
 
-    for epoch in range(epochs_to_train):
+    current_image_size = image_size
+    image_size_throughputs = {}
+
+    start_epoch = 0
+    if train_state is not None:
+        start_epoch = epochs_to_train if train_state["training_finished"] else train_state["epoch"] + 1
+        current_sgdr_cycle_epochs = train_state["current_sgdr_cycle_epochs"]
+        sgdr_next_cycle_end_epoch = train_state["sgdr_next_cycle_end_epoch"]
+        sgdr_iterations = train_state["sgdr_iterations"]
+        sgdr_cycle_count = train_state["sgdr_cycle_count"]
+        batch_count = train_state["batch_count"]
+        epoch_of_last_improval = train_state["epoch_of_last_improval"]
+        ensemble_model_index = train_state["ensemble_model_index"]
+        global_val_mapk_best_avg = train_state["global_val_mapk_best_avg"]
+        sgdr_cycle_val_mapk_best_avg = train_state["sgdr_cycle_val_mapk_best_avg"]
+
+        optimizer.load_state_dict(train_state["optimizer"])
+        lr_scheduler = CosineAnnealingLR(optimizer, T_max=current_sgdr_cycle_epochs, eta_min=lr_min)
+        lr_scheduler.load_state_dict(train_state["lr_scheduler"])
+        lr_scheduler_plateau.load_state_dict(train_state["lr_scheduler_plateau"])
+        if len(train_state["scaler"]) > 0 and mixed_precision.scaler.is_enabled():
+            mixed_precision.scaler.load_state_dict(train_state["scaler"])
+
+        if loss2_type is not None and sgdr_cycle_count >= loss2_start_sgdr_cycle:
+            criterion = create_criterion(loss2_type, len(train_data.categories), bootstraping_loss_ratio)
+        criterion.load_state_dict(train_state["criterion"])
+        if loss_type == "center":
+            optimizer_centloss.load_state_dict(train_state["optimizer_centloss"])
+
+        # the other ranks keep their own random state, so that they do not draw the same samples and augmentations as
+        # the first one
+        if is_main_process():
+            set_random_state(train_state["random"])
+
+    for epoch in range(start_epoch, epochs_to_train):
         epoch_start_time = time.time()
 
         print("memory used: {:.2f} GB".format(psutil.virtual_memory().used / 2 ** 30), flush=True)
@@ -405,10 +685,17 @@ def main():
             next_image_size = \
                 progressive_image_sizes[min(epoch // progressive_image_epoch_step, len(progressive_image_sizes) - 1)]
 
-            if train_set.image_size != next_image_size:
+            if current_image_size != next_image_size:
                 print("changing image size to {}".format(next_image_size), flush=True)
-                train_set.image_size = next_image_size
-                val_set.image_size = next_image_size
+                # with the device resize the images are always rendered (or read from the image cache) at full size and
+                # only downsampled on the device, otherwise they are rendered at the smaller size
+                if progressive_image_device_resize:
+                    image_resize.size = next_image_size
+                else:
+                    train_set.image_size = next_image_size
+                    val_set.image_size = next_image_size
+                current_image_size = next_image_size
+                warmup_model(model, batch_size, 6 if use_extended_stroke_channels else 3, current_image_size)
 
         model.train()
 
@@ -416,24 +703,45 @@ def main():
         train_mapk_sum_t = zero_item_tensor()
 
         epoch_batch_iter_count = 0
+        epoch_sample_count = 0
+        epoch_padding_efficiency_sum = 0.0
+        epoch_train_start_time = time.time()
+
+        # all ranks have to run the same number of batches, as every optimizer step waits for the gradients of all ranks;
+        # it is also the epoch length of the lr schedule, which with bucketed batches is more than len(train_set) /
+        # batch_size as every bucket ends with a partial batch
+        epoch_num_batches = min_across_ranks(len(train_set_data_loader))
 
         for b, batch in enumerate(train_set_data_loader):
-            images, categories, categories_one_hot = \
-                batch[0].to(device, non_blocking=True), \
-                batch[1].to(device, non_blocking=True), \
-                batch[2].to(device, non_blocking=True)
+            if b >= epoch_num_batches:
+                break
+
+            if use_stroke_sequences:
+                # the share of valid (not padded) points, computed from the validity channel while still on the cpu
+                padding_efficiency = batch[0][:, -1].mean().item()
+                epoch_padding_efficiency_sum += padding_efficiency
+                train_summary_writer.add_scalar("padding_efficiency", padding_efficiency, batch_count + 1)
+
+            images, categories, categories_one_hot = batch_to_device(batch, len(train_data.categories))
+            epoch_sample_count += images.size(0)
 
             if lr_scheduler_type == "cosine_annealing":
-                lr_scheduler.step(epoch=min(current_sgdr_cycle_epochs, sgdr_iterations / epoch_iterations))
+                lr_scheduler.step(epoch=min(current_sgdr_cycle_epochs, sgdr_iterations / epoch_num_batches))
 
             if b % batch_iterations == 0:
                 optimizer.zero_grad()
 
-            prediction_logits = model(images)
-            # if prediction_logits.size(1) == len(class_weights):
-            #     criterion.weight = class_weights
-            loss = criterion(prediction_logits, get_loss_target(criterion, categories, categories_one_hot))
-            loss.backward()
+            optimizer_step = (b + 1) % batch_iterations == 0 or (b + 1) == epoch_num_batches
+
+            # with distributed training the gradients of the accumulated batches are only synchronized with the last one
+            with model.no_sync() if distributed and not optimizer_step else nullcontext():
+                prediction_logits = forward_model(model, images)
+                # if prediction_logits.size(1) == len(class_weights):
+                #     criterion.weight = class_weights
+                loss = criterion(prediction_logits, get_loss_target(criterion, categories, categories_one_hot))
+                # the loss is scaled when training in fp16, the gradients of all accumulated batches are unscaled
+                # together when the optimizers are stepped
+                mixed_precision.scaler.scale(loss).backward()
 
             with torch.no_grad():
                 train_loss_sum_t += loss
@@ -441,12 +749,13 @@ def main():
                     train_mapk_sum_t += mapk(prediction_logits, categories,
                                              topk=min(mapk_topk, len(train_data.categories)))
 
-            if (b + 1) % batch_iterations == 0 or (b + 1) == len(train_set_data_loader):
-                optimizer.step()
+            if optimizer_step:
+                mixed_precision.scaler.step(optimizer)
                 if loss_type == "center":
                     for param in criterion.center.parameters():
                         param.grad.data *= (1. / 0.5)
-                    optimizer_centloss.step()
+                    mixed_precision.scaler.step(optimizer_centloss)
+                mixed_precision.scaler.update()
 
             sgdr_iterations += 1
             batch_count += 1
@@ -454,12 +763,19 @@ def main():
 
             optim_summary_writer.add_scalar("lr", get_learning_rate(optimizer), batch_count + 1)
 
-        # TODO: recalculate epoch_iterations and maybe other values?
+        epoch_train_time = time.time() - epoch_train_start_time
+        epoch_throughput = epoch_sample_count / epoch_train_time
+        image_size_throughputs.setdefault(current_image_size, []).append(epoch_throughput)
+
+        # when streaming the shards, only the validation set is switched to the next shard
         train_data = train_data_provider.get_next()
-        train_set.df = train_data.train_set_df
+        if not stream_shards:
+            train_set.df = train_data.train_set_df
         val_set.df = train_data.val_set_df
-        epoch_iterations = ceil(len(train_set) / batch_size)
         stratified_sampler.class_vector = train_data.train_set_df["category"]
+        if not stream_shards and use_stroke_sequences and bucket_sequence_lens:
+            bucket_batch_sampler.class_vector = train_data.train_set_df["category"]
+            bucket_batch_sampler.lengths = train_set.sequence_lens()
 
         train_loss_avg = train_loss_sum_t.item() / epoch_batch_iter_count
         train_mapk_avg = train_mapk_sum_t.item() / epoch_batch_iter_count
@@ -470,20 +786,29 @@ def main():
         if lr_scheduler_type == "reduce_on_plateau":
             lr_scheduler_plateau.step(val_mapk_avg)
 
+        # the model is saved once for all of its checkpoint files
+        model_file_paths = []
+        checkpoint_stall_time = 0.0
+
         model_improved_within_sgdr_cycle = check_model_improved(sgdr_cycle_val_mapk_best_avg, val_mapk_avg)
         if model_improved_within_sgdr_cycle:
-            torch.save(model.state_dict(), "{}/model-{}.pth".format(output_dir, ensemble_model_index))
+            model_file_paths.append("{}/model-{}.pth".format(output_dir, ensemble_model_index))
             sgdr_cycle_val_mapk_best_avg = val_mapk_avg
 
         model_improved = check_model_improved(global_val_mapk_best_avg, val_mapk_avg)
         ckpt_saved = False
         if model_improved:
-            torch.save(model.state_dict(), "{}/model.pth".format(output_dir))
-            torch.save(optimizer.state_dict(), "{}/optimizer.pth".format(output_dir))
+            model_file_paths.append("{}/model.pth".format(output_dir))
+            if is_main_process():
+                checkpoint_stall_time += checkpoint_writer.save(
+                    optimizer.state_dict(), "{}/optimizer.pth".format(output_dir))
             global_val_mapk_best_avg = val_mapk_avg
             epoch_of_last_improval = epoch
             ckpt_saved = True
 
+        if len(model_file_paths) > 0 and is_main_process():
+            checkpoint_stall_time += checkpoint_writer.save(model.state_dict(), model_file_paths)
+
         sgdr_reset = False
         if (lr_scheduler_type == "cosine_annealing") and (epoch + 1 >= sgdr_next_cycle_end_epoch) and (epoch - epoch_of_last_improval >= sgdr_cycle_end_patience):
             sgdr_iterations = 0
@@ -505,6 +830,33 @@ def main():
                 print("switching to loss type '{}'".format(loss2_type), flush=True)
                 criterion = create_criterion(loss2_type, len(train_data.categories), bootstraping_loss_ratio)
 
+        # the state is written after the model checkpoints of the epoch, so that a resumed training never refers to a
+        # checkpoint which was not written
+        train_state = {
+            "epoch": epoch,
+            "training_finished": False,
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "optimizer_centloss": optimizer_centloss.state_dict() if loss_type == "center" else None,
+            "criterion": criterion.state_dict(),
+            "lr_scheduler": lr_scheduler.state_dict(),
+            "lr_scheduler_plateau": lr_scheduler_plateau.state_dict(),
+            "scaler": mixed_precision.scaler.state_dict(),
+            "data": train_data_provider.state_dict(),
+            "random": get_random_state(),
+            "current_sgdr_cycle_epochs": current_sgdr_cycle_epochs,
+            "sgdr_next_cycle_end_epoch": sgdr_next_cycle_end_epoch,
+            "sgdr_iterations": sgdr_iterations,
+            "sgdr_cycle_count": sgdr_cycle_count,
+            "batch_count": batch_count,
+            "epoch_of_last_improval": epoch_of_last_improval,
+            "ensemble_model_index": ensemble_model_index,
+            "global_val_mapk_best_avg": global_val_mapk_best_avg,
+            "sgdr_cycle_val_mapk_best_avg": sgdr_cycle_val_mapk_best_avg
+        }
+        if save_train_state and is_main_process():
+            checkpoint_stall_time += checkpoint_writer.save(train_state, train_state_file_path)
+
         optim_summary_writer.add_scalar("sgdr_cycle", sgdr_cycle_count, epoch + 1)
 
         train_summary_writer.add_scalar("loss", train_loss_avg, epoch + 1)
@@ -541,6 +893,12 @@ def main():
         print('{"chart": "lr_scaled", "x": %d, "y": %.4f}' % (epoch + 1, 1000 * get_learning_rate(optimizer)))
         print('{"chart": "mem_used", "x": %d, "y": %.2f}' % (epoch + 1, psutil.virtual_memory().used / 2 ** 30))
         print('{"chart": "epoch_time", "x": %d, "y": %d}' % (epoch + 1, epoch_duration_time))
+        print('{"chart": "shard_stall_time", "x": %d, "y": %.2f}' % (epoch + 1, train_data_provider.stall_time))
+        print('{"chart": "throughput", "x": %d, "y": %d}' % (epoch + 1, epoch_throughput))
+        print('{"chart": "checkpoint_stall_time", "x": %d, "y": %.3f}' % (epoch + 1, checkpoint_stall_time))
+        if use_stroke_sequences:
+            print('{"chart": "padding_efficiency", "x": %d, "y": %.4f}' % (
+                epoch + 1, epoch_padding_efficiency_sum / epoch_batch_iter_count))
 
         sys.stdout.flush()
 
@@ -556,10 +914,41 @@ def main():
     train_summary_writer.close()
     val_summary_writer.close()
 
+    close_data_loaders(train_set_data_loader, val_set_data_loader)
+
+    # a training which is resumed after it was finished (e.g. by an early abort) only runs the predictions again
+    if save_train_state and is_main_process() and train_state is not None and not train_state["training_finished"]:
+        train_state["training_finished"] = True
+        checkpoint_writer.save(train_state, train_state_file_path)
+
+    # the checkpoints are loaded again for the predictions below
+    checkpoint_writer.close()
+    print("Checkpoints: {}".format(checkpoint_writer.report()), flush=True)
+
+    print()
+    print("Training throughput per image size:")
+    for size, throughputs in sorted(image_size_throughputs.items()):
+        print("  {}: {:.0f} samples/s ({} epochs)".format(size, np.mean(throughputs), len(throughputs)))
+
+    image_resize.size = None
+    if not progressive_image_device_resize:
+        train_set.image_size = image_size
+        val_set.image_size = image_size
+
     train_end_time = time.time()
     print()
     print("Train time: %s" % str(datetime.timedelta(seconds=train_end_time - train_start_time)), flush=True)
 
+    # the evaluation and the predictions after the training only run on the first rank, with a plain model on the full
+    # validation set
+    if distributed:
+        main_process = is_main_process()
+        cleanup_distributed()
+        if not main_process:
+            return
+        model = create_model(type=model_type, input_size=image_size, num_classes=len(train_data.categories)).to(device)
+        val_set.df = train_data.full_val_set_df
+
     if False:
         swa_model = create_model(type=model_type, input_size=image_size, num_classes=len(train_data.categories)).to(
             device)
@@ -567,18 +956,20 @@ def main():
         for f in find_sorted_model_files(output_dir):
             print("merging model '{}' into swa model".format(f), flush=True)
             m = create_model(type=model_type, input_size=image_size, num_classes=len(train_data.categories)).to(device)
-            m.load_state_dict(torch.load(f, map_location=device))
+            load_model_state(m, torch.load(f, map_location=device))
             swa_update_count += 1
             moving_average(swa_model, m, 1.0 / swa_update_count)
             # bn_update(train_set_data_loader, swa_model)
         torch.save(swa_model.state_dict(), "{}/swa_model.pth".format(output_dir))
 
     test_data = TestData(input_dir)
-    test_set = TestDataset(test_data.df, image_size, use_extended_stroke_channels)
-    test_set_data_loader = \
-        DataLoader(test_set, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=pin_memory)
+    test_set = TestDataset(
+        test_data.drawing, test_data.country, image_size, use_extended_stroke_channels, direct_render, uint8_images,
+        sequence_len)
+    test_set_data_loader = create_data_loader(
+        test_set, batch_size, num_workers, pin_memory, persistent_workers, collate_fn=collate_fn)
 
-    model.load_state_dict(torch.load("{}/model.pth".format(output_dir), map_location=device))
+    load_model_state(model, torch.load("{}/model.pth".format(output_dir), map_location=device))
     model = Ensemble([model])
 
     categories = train_data.categories
@@ -595,8 +986,8 @@ def main():
     np.save("{}/submission_predictions_tta.npy".format(output_dir), np.array(predictions))
     submission_df.to_csv("{}/submission_tta.csv".format(output_dir), columns=["word"])
 
-    val_set_data_loader = \
-        DataLoader(val_set, batch_size=64, shuffle=False, num_workers=num_workers, pin_memory=pin_memory)
+    val_set_data_loader = create_data_loader(
+        val_set, 64, num_workers, pin_memory, persistent_workers, collate_fn=collate_fn)
 
     model = load_ensemble_model(output_dir, 3, val_set_data_loader, criterion, model_type, image_size, len(categories))
     submission_df = test_data.df.copy()
@@ -617,19 +1008,36 @@ def main():
     print("Categories sorted by precision:")
     print(np.array(categories)[np.argsort(precisions)])
 
+    close_data_loaders(test_set_data_loader, val_set_data_loader)
+
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
     argparser.add_argument("--input_dir", default="/storage/kaggle/quickdraw")
     argparser.add_argument("--output_dir", default="/artifacts")
     argparser.add_argument("--base_model_dir", default=None)
+    argparser.add_argument("--resume", default=False, type=str2bool)
+    argparser.add_argument("--save_train_state", default=True, type=str2bool)
     argparser.add_argument("--image_size", default=128, type=int)
     argparser.add_argument("--augment", default=False, type=str2bool)
+    argparser.add_argument("--augment_scale", default=0.0, type=float)
+    argparser.add_argument("--augment_shift", default=0.0, type=float)
+    argparser.add_argument("--augment_rotate", default=0.0, type=float)
+    argparser.add_argument("--augment_stroke_dropout", default=0.0, type=float)
+    argparser.add_argument("--augment_point_jitter", default=0.0, type=float)
+    argparser.add_argument("--augment_partition_jitter", default=0, type=int)
+    argparser.add_argument("--direct_render", default=False, type=str2bool)
+    argparser.add_argument("--uint8_images", default=False, type=str2bool)
+    argparser.add_argument("--stroke_sequence_len", default=256, type=int)
+    argparser.add_argument("--bucket_sequence_lens", default=False, type=str2bool)
+    argparser.add_argument("--num_sequence_len_buckets", default=8, type=int)
+    argparser.add_argument("--use_image_cache", default=False, type=str2bool)
     argparser.add_argument("--use_dummy_image", default=False, type=str2bool)
     argparser.add_argument("--use_progressive_image_sizes", default=False, type=str2bool)
     argparser.add_argument("--progressive_image_size_min", default=32, type=int)
     argparser.add_argument("--progressive_image_size_step", default=16, type=int)
     argparser.add_argument("--progressive_image_epoch_step", default=7, type=int)
+    argparser.add_argument("--progressive_image_device_resize", default=False, type=str2bool)
     argparser.add_argument("--epochs", default=500, type=int)
     argparser.add_argument("--batch_size", default=256, type=int)
     argparser.add_argument("--batch_iterations", default=1, type=int)
@@ -644,8 +1052,16 @@ if __name__ == "__main__":
     argparser.add_argument("--mapk_topk", default=3, type=int)
     argparser.add_argument("--num_shard_preload", default=1, type=int)
     argparser.add_argument("--num_shard_loaders", default=1, type=int)
+    argparser.add_argument("--adaptive_shard_preload", default=False, type=str2bool)
+    argparser.add_argument("--max_shard_preload", default=4, type=int)
+    argparser.add_argument("--shard_preload_memory_budget", default=None, type=float)
     argparser.add_argument("--num_workers", default=8, type=int)
     argparser.add_argument("--pin_memory", default=True, type=str2bool)
+    argparser.add_argument("--persistent_workers", default=False, type=str2bool)
+    argparser.add_argument("--stream_shards", default=False, type=str2bool)
+    argparser.add_argument("--num_stream_shards", default=4, type=int)
+    argparser.add_argument("--stream_reservoir_size", default=100000, type=int)
+    argparser.add_argument("--stream_epoch_size", default=1000000, type=int)
     argparser.add_argument("--lr_scheduler", default="cosine_annealing")
     argparser.add_argument("--lr_patience", default=1, type=int)
     argparser.add_argument("--lr_min", default=0.01, type=float)
@@ -653,6 +1069,9 @@ if __name__ == "__main__":
     argparser.add_argument("--lr_min_decay", default=1.0, type=float)
     argparser.add_argument("--lr_max_decay", default=1.0, type=float)
     argparser.add_argument("--model", default="cnn")
+    argparser.add_argument("--mixed_precision", default=False, type=str2bool)
+    argparser.add_argument("--distributed", default=False, type=str2bool)
+    argparser.add_argument("--distributed_backend", default="gloo")
     argparser.add_argument("--patience", default=5, type=int)
     argparser.add_argument("--optimizer", default="sgd")
     argparser.add_argument("--loss", default="cce")
@@ -3,7 +3,8 @@ import math
 
 import cv2
 import numpy as np
-from sklearn.model_selection import StratifiedKFold
+import torch
+from sklearn.model_selection import StratifiedKFold, train_test_split
 from torch import nn
 
 
@@ -37,6 +38,37 @@ def unfreeze(model):
         param.requires_grad = True
 
 
+def load_model_state(model, state_dict):
+    # accepts the state dicts of both wrapped models (DataParallel or DistributedDataParallel, with their keys prefixed
+    # by "module.") and plain ones, whichever kind of model they are loaded into
+    model_prefixed = isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel))
+    state_prefixed = len(state_dict) > 0 and all(k.startswith("module.") for k in state_dict.keys())
+    if model_prefixed and not state_prefixed:
+        state_dict = {"module." + k: v for k, v in state_dict.items()}
+    elif state_prefixed and not model_prefixed:
+        state_dict = {k[len("module."):]: v for k, v in state_dict.items()}
+    model.load_state_dict(state_dict)
+
+
+def get_random_state():
+    # the states of all the random generators the training draws from, with the numpy state stored as a tensor so
+    # that it can be loaded with torch.load(weights_only=True)
+    np_name, np_keys, np_pos, np_has_gauss, np_cached_gaussian = np.random.get_state()
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        "numpy": (np_name, torch.from_numpy(np_keys.astype(np.int64)), np_pos, np_has_gauss, np_cached_gaussian)
+    }
+
+
+def set_random_state(state):
+    torch.set_rng_state(state["torch"])
+    if torch.cuda.is_available() and len(state["cuda"]) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    np_name, np_keys, np_pos, np_has_gauss, np_cached_gaussian = state["numpy"]
+    np.random.set_state((np_name, np_keys.numpy().astype(np.uint32), np_pos, np_has_gauss, np_cached_gaussian))
+
+
 def kfold_split(n_splits, values, classes):
     skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=42)
     for train_value_indexes, test_value_indexes in skf.split(values, classes):
@@ -45,6 +77,20 @@ def kfold_split(n_splits, values, classes):
         yield train_values, test_values
 
 
+def split_indexes(classes, test_size, fold, n_splits=3):
+    # row indexes of the train and val set, a stratified holdout split if no fold is given
+    indexes = np.arange(len(classes))
+    if fold is None:
+        return train_test_split(indexes, test_size=test_size, stratify=classes, random_state=42)
+    else:
+        skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=42)
+        return list(skf.split(indexes, classes))[fold]
+
+
+def split_name(test_size, fold):
+    return "split-holdout{}".format(test_size) if fold is None else "split-fold{}".format(fold)
+
+
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
         return True
@@ -114,25 +160,25 @@ def partition_strokes(strokes, num_partitions):
     return partitions
 
 
-def draw_strokes(strokes, size=256, line_width=7, padding=3, fliplr=False):
-    draw_size = 256
-    scale_factor = (draw_size - 2 * padding) / draw_size
+def draw_strokes(strokes, size=256, line_width=7, padding=3, fliplr=False, direct=False):
+    draw_size, line_width, line_type, shift = calculate_draw_params(size, line_width, direct)
+
+    stroke_x, stroke_y, stroke_lens, _ = flatten_drawings([strokes])
+    points = scale_stroke_points(stroke_x, stroke_y, padding, draw_size, shift)
+    if fliplr:
+        points[:, 0] = (draw_size << shift) - points[:, 0]
 
     image = np.full((draw_size, draw_size), 255, dtype=np.uint8)
 
     stroke_colors = range(0, 240, 40)
 
-    for s, stroke in enumerate(strokes):
+    stroke_point_offset = 0
+    for s, stroke_len in enumerate(stroke_lens):
         stroke_color = stroke_colors[s % len(stroke_colors)]
-        for i in range(len(stroke[0]) - 1):
-            x0 = int(scale_factor * stroke[0][i]) + padding
-            y0 = int(scale_factor * stroke[1][i]) + padding
-            x1 = int(scale_factor * stroke[0][i + 1]) + padding
-            y1 = int(scale_factor * stroke[1][i + 1]) + padding
-            if fliplr:
-                x0 = draw_size - x0
-                x1 = draw_size - x1
-            cv2.line(image, (x0, y0), (x1, y1), stroke_color, line_width)
+        stroke_points = points[stroke_point_offset:stroke_point_offset + stroke_len]
+        stroke_point_offset += stroke_len
+        if stroke_len > 1:
+            cv2.polylines(image, [stroke_points], False, stroke_color, line_width, line_type, shift)
 
     if draw_size != size:
         image = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
@@ -140,6 +186,33 @@ def draw_strokes(strokes, size=256, line_width=7, padding=3, fliplr=False):
     return image
 
 
+def calculate_draw_params(size, line_width, direct):
+    # in direct mode the strokes are drawn on a canvas of the target size, with sub-pixel coordinates and a line width
+    # scaled down accordingly, instead of drawing at 256 and downscaling; anti-aliasing is only used for 1 pixel wide
+    # lines, for wider lines it is considerably slower and not closer to the downscaled rendering
+    if direct:
+        direct_line_width = max(1, int(round(line_width * size / 256)))
+        return size, direct_line_width, cv2.LINE_AA if direct_line_width == 1 else cv2.LINE_8, 4
+    else:
+        return 256, line_width, cv2.LINE_8, 0
+
+
+def scale_stroke_points(stroke_x, stroke_y, padding, draw_size, shift):
+    stroke_x = np.asarray(stroke_x)
+    stroke_y = np.asarray(stroke_y)
+    scale_factor = (256 - 2 * padding) / 256
+
+    points = np.empty((len(stroke_x), 2), dtype=np.int32)
+    if draw_size == 256 and shift == 0:
+        points[:, 0] = (scale_factor * stroke_x).astype(np.int32) + padding
+        points[:, 1] = (scale_factor * stroke_y).astype(np.int32) + padding
+    else:
+        point_scale = draw_size / 256 * (1 << shift)
+        points[:, 0] = np.round((scale_factor * stroke_x + padding) * point_scale)
+        points[:, 1] = np.round((scale_factor * stroke_y + padding) * point_scale)
+    return points
+
+
 def merge_stroke_drawings(drawings):
     merged_drawing = np.full(drawings[0].shape, 255, dtype=np.uint8)
     for drawing in drawings:
@@ -147,48 +220,161 @@ def merge_stroke_drawings(drawings):
     return merged_drawing
 
 
-def draw_temporal_strokes(strokes, size=256, line_width=7, padding=3, fliplr=False, extended_channels=True):
-    draw_size = 256
-    scale_factor = (draw_size - 2 * padding) / draw_size
+def draw_temporal_strokes(strokes, size=256, line_width=7, padding=3, fliplr=False, extended_channels=True, direct=False):
+    stroke_x, stroke_y, stroke_lens, drawing_offsets = flatten_drawings([strokes])
+    return draw_temporal_strokes_batch(
+        stroke_x,
+        stroke_y,
+        stroke_lens,
+        drawing_offsets,
+        size=size,
+        line_width=line_width,
+        padding=padding,
+        fliplr=np.array([fliplr]),
+        extended_channels=extended_channels,
+        direct=direct)[0]
+
+
+def flatten_drawings(drawings):
+    stroke_x = []
+    stroke_y = []
+    stroke_lens = []
+    drawing_offsets = [0]
+    for drawing in drawings:
+        for s in drawing:
+            stroke_x.extend(s[0])
+            stroke_y.extend(s[1])
+            stroke_lens.append(len(s[0]))
+        drawing_offsets.append(len(stroke_lens))
+    return \
+        np.array(stroke_x, dtype=np.uint8), \
+        np.array(stroke_y, dtype=np.uint8), \
+        np.array(stroke_lens, dtype=np.int32), \
+        np.array(drawing_offsets, dtype=np.int32)
+
+
+def encode_stroke_sequences(stroke_x, stroke_y, stroke_lens, drawing_offsets, max_len, fliplr=None):
+    # batch version of flatten_strokes and encode_stroke_start on flat drawings: one (4, n) float32 sequence per drawing
+    # with the x and y points scaled to [0, 1], the stroke start flags and a channel of ones marking the valid points,
+    # which stays zero when the sequences are padded; drawings with more than max_len points are truncated
+    stroke_lens = np.asarray(stroke_lens)
+    drawing_offsets = np.asarray(drawing_offsets)
+    num_drawings = len(drawing_offsets) - 1
+
+    stroke_point_offsets = np.zeros(len(stroke_lens) + 1, dtype=np.int64)
+    np.cumsum(stroke_lens, out=stroke_point_offsets[1:])
+    drawing_point_offsets = stroke_point_offsets[drawing_offsets]
+
+    sequences = np.empty((4, stroke_point_offsets[-1]), dtype=np.float32)
+    np.multiply(stroke_x, 1 / 255., out=sequences[0], casting="unsafe")
+    np.multiply(stroke_y, 1 / 255., out=sequences[1], casting="unsafe")
+    sequences[2] = 0
+    sequences[2, stroke_point_offsets[:-1][stroke_lens > 0]] = 1
+    sequences[3] = 1
+
+    if fliplr is not None and np.any(fliplr):
+        point_fliplr = np.repeat(np.asarray(fliplr, dtype=np.bool_), np.diff(drawing_point_offsets))
+        sequences[0, point_fliplr] = 1 - sequences[0, point_fliplr]
+
+    return [
+        sequences[:, drawing_point_offsets[d]:min(drawing_point_offsets[d + 1], drawing_point_offsets[d] + max_len)]
+        for d in range(num_drawings)
+    ]
+
+
+def partition_stroke_ranges(stroke_lens, num_partitions):
+    # same partitioning as partition_strokes, but returned as stroke index boundaries instead of nested lists
+    num_strokes = len(stroke_lens)
+    boundaries = [0]
+    if num_strokes > 0:
+        cumulative_points = np.cumsum(stroke_lens)
+        partition_num_points = math.ceil(cumulative_points[-1] / num_partitions)
+        partition_start_points = 0
+        while boundaries[-1] < num_strokes and len(boundaries) <= num_partitions:
+            end = np.searchsorted(cumulative_points, partition_start_points + partition_num_points, side="left")
+            end = min(end, num_strokes - 1) + 1
+            boundaries.append(end)
+            partition_start_points = cumulative_points[end - 1]
+    boundaries.extend([boundaries[-1]] * (num_partitions + 1 - len(boundaries)))
+    return boundaries
+
+
+def merge_stroke_drawings_batch(drawings):
+    merged_drawing = drawings[0]
+    for drawing in drawings[1:]:
+        merged_drawing = np.where(drawing != 255, drawing, merged_drawing)
+    return merged_drawing
 
-    stroke_colors = range(0, 240, 40)
 
-    partition_images = []
-
-    stroke_partitions = partition_strokes(strokes, 3)
-    stroke_color_index = 0
-    for stroke_partition in stroke_partitions:
-        image = np.full((draw_size, draw_size), 255, dtype=np.uint8)
-        partition_images.append(image)
-
-        for stroke in stroke_partition:
-            stroke_color = stroke_colors[stroke_color_index % len(stroke_colors)]
-            stroke_color_index += 1
-            for i in range(len(stroke[0]) - 1):
-                x0 = int(scale_factor * stroke[0][i]) + padding
-                y0 = int(scale_factor * stroke[1][i]) + padding
-                x1 = int(scale_factor * stroke[0][i + 1]) + padding
-                y1 = int(scale_factor * stroke[1][i + 1]) + padding
-                if fliplr:
-                    x0 = draw_size - x0
-                    x1 = draw_size - x1
-                cv2.line(image, (x0, y0), (x1, y1), stroke_color, line_width)
+def draw_temporal_strokes_batch(
+        stroke_x,
+        stroke_y,
+        stroke_lens,
+        drawing_offsets,
+        size=256,
+        line_width=7,
+        padding=3,
+        fliplr=None,
+        extended_channels=True,
+        direct=False,
+        stroke_partitions=None):
+    # stroke_x/stroke_y hold the points of all strokes back to back, stroke_lens the number of points per stroke and
+    # drawing_offsets the index of the first stroke of each drawing followed by the total number of strokes; the points
+    # may also be float coordinates (e.g. augmented ones), and stroke_partitions optionally holds the stroke boundaries
+    # of the 3 temporal partitions of every drawing instead of them being calculated from the number of points
+    draw_size, line_width, line_type, shift = calculate_draw_params(size, line_width, direct)
+    num_drawings = len(drawing_offsets) - 1
 
-    if draw_size != size:
-        partition_images = [cv2.resize(i, (size, size), interpolation=cv2.INTER_AREA) for i in partition_images]
+    stroke_colors = range(0, 240, 40)
 
-    final_images = []
+    stroke_point_offsets = np.zeros(len(stroke_lens) + 1, dtype=np.int64)
+    np.cumsum(stroke_lens, out=stroke_point_offsets[1:])
+
+    points = scale_stroke_points(stroke_x, stroke_y, padding, draw_size, shift)
+    if fliplr is not None and np.any(fliplr):
+        drawing_offsets = np.asarray(drawing_offsets)
+        drawing_num_points = stroke_point_offsets[drawing_offsets[1:]] - stroke_point_offsets[drawing_offsets[:-1]]
+        point_fliplr = np.repeat(np.asarray(fliplr, dtype=np.bool_), drawing_num_points)
+        points[point_fliplr, 0] = (draw_size << shift) - points[point_fliplr, 0]
+
+    # a single canvas is reused for all drawings, only the (usually much smaller) resized images are kept per drawing
+    canvas = np.empty((3, draw_size, draw_size), dtype=np.uint8)
+    partition_images = np.empty((num_drawings, 3, size, size), dtype=np.uint8)
+
+    for d in range(num_drawings):
+        canvas.fill(255)
+        first_stroke = drawing_offsets[d]
+        if stroke_partitions is not None:
+            stroke_boundaries = stroke_partitions[d]
+        else:
+            stroke_boundaries = partition_stroke_ranges(stroke_lens[first_stroke:drawing_offsets[d + 1]], 3)
+        for p in range(3):
+            image = canvas[p]
+            for s in range(first_stroke + stroke_boundaries[p], first_stroke + stroke_boundaries[p + 1]):
+                if stroke_lens[s] < 2:
+                    continue
+                stroke_color = stroke_colors[(s - first_stroke) % len(stroke_colors)]
+                stroke_points = points[stroke_point_offsets[s]:stroke_point_offsets[s + 1]]
+                cv2.polylines(image, [stroke_points], False, stroke_color, line_width, line_type, shift)
+
+            if draw_size != size:
+                partition_images[d, p] = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+            else:
+                partition_images[d, p] = image
+
+    p0, p1, p2 = partition_images[:, 0], partition_images[:, 1], partition_images[:, 2]
+    p01 = merge_stroke_drawings_batch([p0, p1])
+    p012 = merge_stroke_drawings_batch([p01, p2])
     if extended_channels:
-        final_images.extend(partition_images)
-        final_images.append(merge_stroke_drawings([partition_images[0], partition_images[1]]))
-        final_images.append(merge_stroke_drawings([partition_images[1], partition_images[2]]))
-        final_images.append(merge_stroke_drawings([partition_images[0], partition_images[1], partition_images[2]]))
+        final_images = [p0, p1, p2, p01, merge_stroke_drawings_batch([p1, p2]), p012]
     else:
-        final_images.append(partition_images[0])
-        final_images.append(merge_stroke_drawings([partition_images[0], partition_images[1]]))
-        final_images.append(merge_stroke_drawings([partition_images[0], partition_images[1], partition_images[2]]))
+        final_images = [p0, p01, p012]
+
+    return np.stack(final_images, axis=1)
+
 
-    return np.array(final_images)
+def image_cache_name(image_size, extended_channels, direct):
+    return "img{}-{}ch{}".format(image_size, 6 if extended_channels else 3, "-direct" if direct else "")
 
 
 def calculate_drawing_values_channel(drawing, country, size):